@@ -0,0 +1,246 @@
+#!/usr/bin/env python3
+
+import argparse
+import ast
+import importlib
+import json
+import multiprocessing
+import os
+import resource
+import subprocess
+import sys
+import time
+
+import numpy as np
+
+from common import read_cities
+from input_generator import LAYOUTS, generate
+from profiling import profiler
+
+# 何も指定しないときに比べるソルバー(モジュール名:solveのキーワード引数)
+DEFAULT_SOLVERS = (
+    'solver_greedy',
+    'solver_2opt:num_neighbors=10',
+    'solver_greedy_2_opt_or_1_opt_or_2_opt:num_neighbors=10',
+    'solver_lk',
+    'solver_annealing:time_limit=10',
+)
+# 何も指定しないときに使う問題(input_generator.pyで作った課題の入力)
+DEFAULT_INSTANCES = tuple(f'input_{i}' for i in range(7))
+# 一回の実行の制限時間(秒)
+TIMEOUT = 600
+# --compareで遅くなったとみなす時間の比
+TIME_TOLERANCE = 1.2
+# これより短い時間の差は測定の誤差とみなす(秒)
+MIN_TIME_DIFFERENCE = 0.05
+
+
+# 'solver_2opt:num_neighbors=10,workers=2' を ('solver_2opt', {'num_neighbors': 10, 'workers': 2}) にする
+def parse_solver(spec):
+    module, _, options = spec.partition(':')
+    kwargs = {}
+    for option in filter(None, options.split(',')):
+        key, _, value = option.partition('=')
+        kwargs[key] = ast.literal_eval(value)
+    return module, kwargs
+
+
+# TSPLIBのEUC_2Dの.tspファイルからNODE_COORD_SECTIONの座標を読み込む
+def read_tsplib(filename):
+    cities = []
+    with open(filename) as f:
+        in_coords = False
+        for line in f:
+            line = line.strip()
+            if line == 'NODE_COORD_SECTION':
+                in_coords = True
+            elif line in ('EOF', '') or not in_coords:
+                continue
+            elif line[0].isdigit():
+                _, x, y = line.split()[:3]
+                cities.append((float(x), float(y)))
+            else:
+                in_coords = False
+    return np.array(cities, dtype=np.float64).reshape(-1, 2)
+
+
+# 問題の名前から都市の座標を返す
+# input_3 -> input_3.csv、random_8192 -> input_generator.pyで一様に作った8192都市、
+# clustered_8192 -> input_generator.pyのclusteredの配置で作った8192都市(grid, gaussianも同じ)、
+# 'xxx.tsp'ならTSPLIBのファイル、それ以外ならread_citiesで読めるファイル
+# |seed|: 都市を作る乱数のシード
+def load_instance(name, seed=1):
+    layout, _, n = name.rpartition('_')
+    if layout == 'random':
+        layout = 'uniform'
+    if layout in LAYOUTS and n.isdigit():
+        return generate(int(n), layout, seed)
+    if name.endswith('.tsp'):
+        return read_tsplib(name)
+    if os.path.exists(name + '.csv'):
+        return read_cities(name + '.csv')
+    return read_cities(name)
+
+
+# 座標から都市リストの総合距離を計算する、最初と最後の都市が同じでもよい
+# 都市リストがすべての都市を一度ずつ訪れていなければValueError
+def tour_length(cities, tour):
+    tour = np.asarray(tour, dtype=np.int64)
+    if len(tour) > 1 and tour[0] == tour[-1]:
+        tour = tour[:-1]
+    N = len(cities)
+    if len(tour) != N or not np.array_equal(np.sort(tour), np.arange(N)):
+        raise ValueError('the tour does not visit every city exactly once')
+    xy = cities[tour]
+    diff = xy - np.roll(xy, -1, axis=0)
+    return float(np.hypot(diff[:, 0], diff[:, 1]).sum())
+
+
+# 別のプロセスで一つのソルバーを一つの問題に実行し、結果をqueueに入れる
+# ソルバーの表示は捨て、ピークメモリはこのプロセスの最大RSSで測る
+# profilerを有効にして、改善量を計算した手の数(*.evaluatedと焼きなましの提案の数)から1秒あたりの手の数を出す
+def _run_one(module_name, kwargs, cities, queue):
+    sys.stdout = open(os.devnull, 'w')
+    try:
+        module = importlib.import_module(module_name)
+        city_list = list(map(tuple, cities.tolist()))
+        profiler.enable()
+        start = time.perf_counter()
+        tour = module.solve(city_list, **kwargs)
+        elapsed = time.perf_counter() - start
+        profiler.disable()
+        peak_kb = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        moves = sum(value for name, value in profiler.counters.items()
+                    if name.endswith('.evaluated') or name == 'annealing.proposals')
+        queue.put({'time': elapsed, 'peak_memory_mb': peak_kb / 1024,
+                   'length': tour_length(cities, tour),
+                   'moves_per_second': moves / max(elapsed, 1e-9),
+                   'phases': profiler.to_dict()['phases'],
+                   'counters': profiler.counters})
+    except Exception as e:
+        queue.put({'error': f'{type(e).__name__}: {e}'})
+
+
+# 一つのソルバーを一つの問題に実行して結果のdictを返す
+# 毎回新しいプロセスで実行するので、ピークメモリが前の実行に影響されず、制限時間を過ぎたら止められる
+def run(module_name, kwargs, cities, timeout=TIMEOUT):
+    context = multiprocessing.get_context('spawn')
+    queue = context.Queue()
+    process = context.Process(target=_run_one, args=(module_name, kwargs, cities, queue))
+    process.start()
+    try:
+        result = queue.get(timeout=timeout)
+    except Exception:
+        result = {'error': f'timeout after {timeout} s'}
+        process.terminate()
+    process.join()
+    return result
+
+
+def git_commit():
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True,
+                              text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+# すべてのソルバーをすべての問題に実行し、結果のdictのリストを返す
+# gapは最良既知値(best_known)があればそれとの差、なければその問題で一番短かった結果との差の割合
+# |solvers|: 'モジュール名:キーワード引数' のリスト
+# |instances|: load_instanceに渡す問題の名前のリスト
+# |best_known|: 問題の名前から最良既知値へのdict
+# |verbose|: Trueなら問題ごとに結果を表示する
+def run_benchmark(solvers, instances, best_known=None, timeout=TIMEOUT, seed=1, verbose=True):
+    best_known = best_known or {}
+    commit = git_commit()
+    results = []
+    for instance in instances:
+        cities = load_instance(instance, seed)
+        instance_results = []
+        for spec in solvers:
+            module_name, kwargs = parse_solver(spec)
+            result = {'commit': commit, 'solver': spec, 'instance': instance, 'num_cities': len(cities)}
+            result.update(run(module_name, kwargs, cities, timeout))
+            instance_results.append(result)
+
+        lengths = [r['length'] for r in instance_results if 'length' in r]
+        reference = best_known.get(instance, min(lengths, default=None))
+        for result in instance_results:
+            if 'length' in result and reference:
+                result['gap'] = result['length'] / reference - 1
+                result['gap_reference'] = 'best_known' if instance in best_known else 'best_in_run'
+            if verbose:
+                print(format_result(result))
+        results.extend(instance_results)
+    return results
+
+
+def format_result(result):
+    if 'error' in result:
+        status = result['error']
+    else:
+        status = f"{result['length']:12.2f} {result['time']:9.3f} s {result['peak_memory_mb']:8.1f} MB"
+        if 'gap' in result:
+            status += f" {100 * result['gap']:7.2f} %"
+    return f"{result['instance']:>14} {result['solver']:<50} {status}"
+
+
+# 二つの結果を(solver, instance)ごとに比べ、遅くなったものと長くなったものを表示する
+# 遅くなったか長くなったものがあればTrueを返す
+def compare(baseline, results, time_tolerance=TIME_TOLERANCE):
+    old = {(r['solver'], r['instance']): r for r in baseline}
+    regressed = False
+    for result in results:
+        before = old.get((result['solver'], result['instance']))
+        if before is None or 'length' not in before or 'length' not in result:
+            continue
+        ratio = result['time'] / max(before['time'], 1e-9)
+        change = result['length'] / before['length'] - 1
+        flags = []
+        if ratio > time_tolerance and result['time'] - before['time'] > MIN_TIME_DIFFERENCE:
+            flags.append('SLOWER')
+        if change > 1e-9:
+            flags.append('LONGER')
+        regressed = regressed or bool(flags)
+        print(f"{result['instance']:>14} {result['solver']:<50} "
+              f"time x{ratio:6.2f} length {100 * change:+7.3f} % {' '.join(flags)}")
+    return regressed
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Run solvers on instances and record time, memory and tour length.')
+    parser.add_argument('--solvers', nargs='+', default=DEFAULT_SOLVERS,
+                        help="modules with a solve(cities) function, e.g. 'solver_2opt:num_neighbors=10'")
+    parser.add_argument('--instances', nargs='+', default=DEFAULT_INSTANCES,
+                        help='input_N, random_N, clustered_N, grid_N, gaussian_N (N generated cities), '
+                             'a TSPLIB .tsp file or a cities file')
+    parser.add_argument('--best-known', default=None,
+                        help='JSON file mapping instance names to best known tour lengths')
+    parser.add_argument('--timeout', type=float, default=TIMEOUT, help='seconds per run')
+    parser.add_argument('--seed', type=int, default=1, help='seed for generated instances')
+    parser.add_argument('--output', default=None, help='write the results as JSON lines to this file')
+    parser.add_argument('--compare', default=None,
+                        help='JSON lines file of an earlier run to compare with (exit status 1 on regressions)')
+    args = parser.parse_args()
+
+    best_known = None
+    if args.best_known:
+        with open(args.best_known) as f:
+            best_known = json.load(f)
+
+    results = run_benchmark(args.solvers, args.instances, best_known, args.timeout, args.seed)
+    if args.output:
+        with open(args.output, 'w') as f:
+            for result in results:
+                f.write(json.dumps(result, sort_keys=True) + '\n')
+
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = [json.loads(line) for line in f if line.strip()]
+        if compare(baseline, results):
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
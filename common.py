@@ -1,10 +1,55 @@
+import math
+from array import array
+
+import numpy as np
+
+from profiling import profiler
+
+# 出力ファイルを書くときに一度に文字列にする都市の数
+WRITE_CHUNK_SIZE = 1 << 16
+# 距離行列がこのバイト数を超えるときは、行列を作らずにDistanceOracleで距離を計算する
+MAX_MATRIX_BYTES = 1 << 30
+# DistanceOracleで覚えておく辺の数(1辺16バイト)
+# CPythonではキャッシュを引く手間が座標から計算し直す手間とほぼ同じなので、デフォルトでは使わない
+ORACLE_CACHE_SIZE = 0
+# build_distance_matrixで選べる距離行列の持ち方
+MATRIX_STORAGES = ('list', 'array', 'float32', 'packed')
+# 入れ子のリストの1要素のおおよそのバイト数(リストのポインタ8バイトとfloatのオブジェクト24バイト)
+LIST_ENTRY_BYTES = 32
+
+
 def read_input(filename):
-    with open(filename) as f:
-        cities = []
-        for line in f.readlines()[1:]:  # Ignore the first line.
-            xy = line.split(',')
-            cities.append((float(xy[0]), float(xy[1])))
-        return cities
+    return list(map(tuple, read_cities(filename).tolist()))
+
+
+# 都市の座標を(N, 2)のfloat64の配列として読み込む
+# CSV(一行目は見出し)はC実装のnp.loadtxtで直接配列にし、.npyならそのまま読み込む
+# |mmap|: Trueなら.npyをメモリマップで開き、必要な部分だけ読み込む
+def read_cities(filename, mmap=False):
+    if filename.endswith('.npy'):
+        return np.load(filename, mmap_mode='r' if mmap else None)
+    cities = np.loadtxt(filename, delimiter=',', skiprows=1, dtype=np.float64, ndmin=2)
+    return cities.reshape(-1, 2)
+
+
+# 都市の座標をCSVか.npyで書き出す
+def write_cities(cities, filename):
+    cities = np.asarray(cities, dtype=np.float64).reshape(-1, 2)
+    if filename.endswith('.npy'):
+        np.save(filename, cities)
+        return
+    with open(filename, 'w') as f:
+        f.write('x,y\n')
+        for start in range(0, len(cities), WRITE_CHUNK_SIZE):
+            chunk = cities[start: start + WRITE_CHUNK_SIZE].tolist()
+            f.write(''.join(f'{x},{y}\n' for x, y in chunk))
+
+
+# 都市リストを読み込む、CSV(一行目はindex)でも.npyでもよい
+def read_tour(filename, mmap=False):
+    if filename.endswith('.npy'):
+        return np.load(filename, mmap_mode='r' if mmap else None)
+    return np.loadtxt(filename, skiprows=1, dtype=np.int64, ndmin=1)
 
 
 def format_tour(tour):
@@ -14,6 +59,292 @@ def format_tour(tour):
 def print_tour(tour):
     print(format_tour(tour))
 
+# 都市リストを書き出す、出力全体を一つの文字列にせずWRITE_CHUNK_SIZE都市ずつ書いていく
+# 中身はformat_tourと同じで、ファイル名が.npyならint64の配列として保存する
 def write_tour(tour, filename):
+    if filename.endswith('.npy'):
+        np.save(filename, np.asarray(tour, dtype=np.int64))
+        return
     with open(filename, "w") as f:
-        f.write(format_tour(tour))
+        f.write('index')
+        for start in range(0, len(tour), WRITE_CHUNK_SIZE):
+            f.write('\n')
+            f.write('\n'.join(map(str, tour[start: start + WRITE_CHUNK_SIZE])))
+
+
+def distance(city1, city2):
+    return math.sqrt((city1[0] - city2[0]) ** 2 + (city1[1] - city2[1]) ** 2)
+
+
+# 都市同士の距離行列をNumPyのブロードキャストで一度に計算して返す
+# ソルバーは純粋なPythonのループでdist[a][b]を一つずつ引くので、デフォルトではlist[list[float]]にして返す
+# (np.ndarrayの要素を一つ引くのはリストより8倍ほど遅い)
+# |cities|: 都市のx座標とy座標のリスト(N x 2の配列でもよい)
+# |storage|: 距離の持ち方、MATRIX_STORAGESのどれか
+#   'list': 入れ子のリスト(一番速いが1要素30バイトほど)
+#   'array': float64のnp.ndarray(1要素8バイト)
+#   'float32': float32のnp.ndarray(1要素4バイト)
+#   'packed': 上三角部分だけを一次元で持つPackedDistanceMatrix(1要素4バイト相当)
+# |max_bytes|: 行列がこれより大きくなるときは、'list'なら'array'に、それでも大きければ
+#   座標から距離を計算するDistanceOracleにする(メモリはO(N))
+@profiler.timed('distance_matrix')
+def build_distance_matrix(cities, storage='list', max_bytes=MAX_MATRIX_BYTES):
+    if storage not in MATRIX_STORAGES:
+        raise ValueError(f'unknown distance matrix storage {storage!r} (one of {", ".join(MATRIX_STORAGES)})')
+    xy = np.asarray(cities, dtype=np.float64).reshape(-1, 2)
+    N = len(xy)
+    if storage == 'list' and max_bytes is not None and N * N * LIST_ENTRY_BYTES > max_bytes:
+        storage = 'array'
+    if storage == 'packed':
+        nbytes = N * (N - 1) // 2 * 8
+    else:
+        nbytes = N * N * (4 if storage == 'float32' else 8)
+    if max_bytes is not None and nbytes > max_bytes:
+        return DistanceOracle(xy)
+    if storage == 'packed':
+        return PackedDistanceMatrix(xy)
+
+    dtype = np.float32 if storage == 'float32' else np.float64
+    x = xy[:, 0].astype(dtype)
+    y = xy[:, 1].astype(dtype)
+    dist = np.subtract.outer(x, x)
+    np.hypot(dist, np.subtract.outer(y, y), out=dist)
+    return dist.tolist() if storage == 'list' else dist
+
+
+# ソルバーのargparseに距離行列の持ち方のオプションを加える
+def add_matrix_arguments(parser):
+    parser.add_argument('--matrix', choices=MATRIX_STORAGES, default='list',
+                        help='how to store the distance matrix: nested lists (fastest), a float64 or float32 '
+                             'NumPy array, or a packed upper triangle (least memory)')
+
+
+class PackedDistanceMatrix:
+    """
+    Distance matrix that stores only the upper triangle (i < j) in a flat array.
+
+    It uses N * (N - 1) / 2 entries instead of N * N, and still supports the
+    dist[a][b] (and dist[a, b]) access used by the solvers. np.asarray() on it
+    gives the dense N x N array.
+
+    Attributes:
+        num_cities (int): Number of cities.
+        data (np.ndarray): Flat array of the distances of every pair i < j, row by row.
+    """
+
+    def __init__(self, xy, dtype=np.float64):
+        N = len(xy)
+        self.num_cities = N
+        self.offsets = self._offsets(N)
+        self.data = np.empty(N * (N - 1) // 2, dtype=dtype)
+
+        # 行ごとに自分より後ろの都市との距離を計算して詰めていく
+        for i in range(N):
+            row = xy[i + 1:] - xy[i]
+            start = self.offsets[i] + i + 1
+            self.data[start: start + len(row)] = np.hypot(row[:, 0], row[:, 1])
+
+    @classmethod
+    def from_data(cls, num_cities, data):
+        """
+        Wraps a flat array of distances (the data of another PackedDistanceMatrix,
+        e.g. in shared memory) without copying it.
+        """
+        matrix = cls.__new__(cls)
+        matrix.num_cities = num_cities
+        matrix.offsets = cls._offsets(num_cities)
+        matrix.data = data
+        return matrix
+
+    @staticmethod
+    def _offsets(N):
+        # offsets[i] + j は都市iと都市j(i < j)の距離が入っている位置(i行目はi * (N - 1) - i * (i - 1) / 2から始まる)
+        return [i * (N - 1) - i * (i - 1) // 2 - i - 1 for i in range(N)]
+
+    def __len__(self):
+        return self.num_cities
+
+    def __getitem__(self, key):
+        if isinstance(key, tuple):
+            a, b = key
+            return self.get(a, b)
+        if not 0 <= key < self.num_cities:
+            raise IndexError(f'city {key} is out of range 0..{self.num_cities - 1}')
+        return _PackedRow(self, key)
+
+    def __iter__(self):
+        for a in range(self.num_cities):
+            yield _PackedRow(self, a)
+
+    def __array__(self, dtype=None, copy=None):
+        N = self.num_cities
+        dense = np.zeros((N, N), dtype=self.data.dtype if dtype is None else dtype)
+        upper = np.triu_indices(N, 1)
+        dense[upper] = self.data
+        dense.T[upper] = self.data
+        return dense
+
+    def get(self, a, b):
+        """
+        Returns the distance between city a and city b.
+        """
+        N = self.num_cities
+        if not (0 <= a < N and 0 <= b < N):
+            raise IndexError(f'city {a if not 0 <= a < N else b} is out of range 0..{N - 1}')
+        if a < b:
+            return self.data[self.offsets[a] + b]
+        if a > b:
+            return self.data[self.offsets[b] + a]
+        return 0.0
+
+    def row(self, a):
+        """
+        Returns the distances from city a to every city as a dense array.
+        """
+        N = self.num_cities
+        if not 0 <= a < N:
+            raise IndexError(f'city {a} is out of range 0..{N - 1}')
+        row = np.zeros(N, dtype=self.data.dtype)
+        row[:a] = self.data[np.array(self.offsets[:a], dtype=np.int64) + a]
+        row[a + 1:] = self.data[self.offsets[a] + a + 1: self.offsets[a] + N]
+        return row
+
+
+class _PackedRow:
+    """
+    Lightweight view of one row of a PackedDistanceMatrix, so that dist[a][b] works.
+    """
+    __slots__ = ('matrix', 'a')
+
+    def __init__(self, matrix, a):
+        self.matrix = matrix
+        self.a = a
+
+    def __getitem__(self, b):
+        return self.matrix.get(self.a, b)
+
+    def __len__(self):
+        return self.matrix.num_cities
+
+    def __iter__(self):
+        return iter(self.matrix.row(self.a).tolist())
+
+    def __array__(self, dtype=None, copy=None):
+        row = self.matrix.row(self.a)
+        return row if dtype is None else row.astype(dtype)
+
+
+class DistanceOracle:
+    """
+    Distance provider that computes distances from the coordinates on demand,
+    for instances whose N x N matrix does not fit in memory.
+
+    Recently used edges (the neighbor and tour edges that local search keeps
+    looking at) are kept in a direct-mapped cache of cache_size entries: the
+    edge (a, b), a < b, goes into the slot (a * N + b) % cache_size and replaces
+    whatever was there. The memory is O(N + cache_size) whatever the number of
+    accesses, and dist[a][b] (and dist[a, b]) work as with the matrix.
+    np.asarray() on it computes the dense N x N array.
+
+    Attributes:
+        num_cities (int): Number of cities.
+        xy (np.ndarray): N x 2 array of the coordinates of the cities.
+        cache_size (int): Number of cached edges, 0 disables the cache.
+        keys (array): a * N + b of the edge in each slot, -1 when empty.
+        values (array): Distance of the edge in each slot.
+    """
+
+    def __init__(self, xy, cache_size=ORACLE_CACHE_SIZE):
+        self.xy = np.asarray(xy, dtype=np.float64).reshape(-1, 2)
+        self.num_cities = len(self.xy)
+        self.xs = self.xy[:, 0].tolist()
+        self.ys = self.xy[:, 1].tolist()
+        self.cache_size = cache_size
+        self.keys = array('q', [-1]) * cache_size
+        self.values = array('d', [0.0]) * cache_size
+
+    def __len__(self):
+        return self.num_cities
+
+    def __getitem__(self, key):
+        if isinstance(key, tuple):
+            a, b = key
+            return self.get(a, b)
+        if not 0 <= key < self.num_cities:
+            raise IndexError(f'city {key} is out of range 0..{self.num_cities - 1}')
+        return _OracleRow(self, key)
+
+    def __iter__(self):
+        for a in range(self.num_cities):
+            yield _OracleRow(self, a)
+
+    def __array__(self, dtype=None, copy=None):
+        diff_x = np.subtract.outer(self.xy[:, 0], self.xy[:, 0])
+        dense = np.hypot(diff_x, np.subtract.outer(self.xy[:, 1], self.xy[:, 1]), out=diff_x)
+        return dense if dtype is None else dense.astype(dtype)
+
+    def __getstate__(self):
+        # ワーカープロセスには座標だけを送り、キャッシュは向こうで作り直す
+        return {'xy': self.xy, 'cache_size': self.cache_size}
+
+    def __setstate__(self, state):
+        self.__init__(state['xy'], state['cache_size'])
+
+    def get(self, a, b):
+        """
+        Returns the distance between city a and city b.
+        """
+        N = self.num_cities
+        if not (0 <= a < N and 0 <= b < N):
+            raise IndexError(f'city {a if not 0 <= a < N else b} is out of range 0..{N - 1}')
+        return self._distance(a, b)
+
+    def _distance(self, a, b):
+        # 番号が範囲内か確かめずに距離を返す(dist[a][b]ではaは行を作るときに確かめてある)
+        if not self.cache_size:
+            return math.hypot(self.xs[a] - self.xs[b], self.ys[a] - self.ys[b])
+        key = a * self.num_cities + b if a < b else b * self.num_cities + a
+        slot = key % self.cache_size
+        keys = self.keys
+        if keys[slot] == key:
+            return self.values[slot]
+        d = math.hypot(self.xs[a] - self.xs[b], self.ys[a] - self.ys[b])
+        keys[slot] = key
+        self.values[slot] = d
+        return d
+
+    def row(self, a):
+        """
+        Returns the distances from city a to every city as a dense array.
+        """
+        if not 0 <= a < self.num_cities:
+            raise IndexError(f'city {a} is out of range 0..{self.num_cities - 1}')
+        diff = self.xy - self.xy[a]
+        return np.hypot(diff[:, 0], diff[:, 1])
+
+
+class _OracleRow:
+    """
+    Lightweight view of one row of a DistanceOracle, so that dist[a][b] works.
+    """
+    __slots__ = ('oracle', 'a')
+
+    def __init__(self, oracle, a):
+        self.oracle = oracle
+        self.a = a
+
+    def __getitem__(self, b):
+        oracle = self.oracle
+        if not 0 <= b < oracle.num_cities:
+            raise IndexError(f'city {b} is out of range 0..{oracle.num_cities - 1}')
+        return oracle._distance(self.a, b)
+
+    def __len__(self):
+        return self.oracle.num_cities
+
+    def __iter__(self):
+        return iter(self.oracle.row(self.a).tolist())
+
+    def __array__(self, dtype=None, copy=None):
+        row = self.oracle.row(self.a)
+        return row if dtype is None else row.astype(dtype)
@@ -0,0 +1,314 @@
+#!/usr/bin/env python3
+
+import sys
+
+import numpy as np
+
+from common import print_tour, read_input
+from neighbors import NUM_NEIGHBORS, DynamicCityGrid, k_nearest_neighbors
+from profiling import profiler
+
+# 空間充填曲線で座標を整数にするときのビット数(一辺を2^CURVE_ORDERに分ける)
+CURVE_ORDER = 16
+
+
+# 貪欲法(最近傍法)で、まだ訪問していない都市の中で一番近い都市を次に訪問し、その都市リストを返す
+# 距離行列は使わず、訪問した都市を消していけるグリッドで一番近い都市を探すので、全体でO(N log N)程度で終わる
+# 同じ距離の都市が複数あるときは番号が小さい方を選ぶ
+# |cities|: 都市のx座標とy座標のリスト(N x 2の配列でもよい)
+# |start_city|: 最初に訪問する都市番号
+# 返り値の都市リストは最初の都市に戻ってこない(長さN)
+@profiler.timed('construction')
+def nearest_neighbor_tour(cities, start_city: int = 0) -> list[int]:
+    xy = np.asarray(cities, dtype=np.float64).reshape(-1, 2)
+    if len(xy) == 0:
+        return []
+    grid = DynamicCityGrid(xy)
+    xs, ys = grid.xs, grid.ys
+
+    current_city = start_city
+    grid.remove(current_city)
+    tour = [current_city]
+    while grid.remaining:
+        current_city = grid.nearest(xs[current_city], ys[current_city])
+        grid.remove(current_city)
+        tour.append(current_city)
+    return tour
+
+
+# 座標を一辺2^orderの格子の整数座標にする(縦横の比は変えない)
+def _grid_coordinates(xy, order):
+    low = xy.min(axis=0)
+    extent = max(float((xy.max(axis=0) - low).max()), 1e-12)
+    scaled = (xy - low) / extent * ((1 << order) - 1)
+    return scaled[:, 0].astype(np.int64), scaled[:, 1].astype(np.int64)
+
+
+# Hilbert曲線に沿った番号を全部の都市についてまとめて計算する
+# 上の桁から2ビットずつ決め、そのたびに残りの部分を曲線の向きに合わせて回転、反転する
+# 0 <= x < n なので n - 1 - x は x ^ (n - 1) と同じ、入れ替えと反転はXORでその場で行う
+def hilbert_index(x, y, order=CURVE_ORDER):
+    n = 1 << order
+    x, y = x.copy(), y.copy()
+    d = np.zeros(len(x), dtype=np.int64)
+    for bit in range(order - 1, -1, -1):
+        rx = (x >> bit) & 1
+        ry = (y >> bit) & 1
+        d += ((3 * rx) ^ ry) << (2 * bit)
+        # ry == 0 のときは、rx == 1 なら反転してからxとyを入れ替える
+        flip = -((1 - ry) & rx) & (n - 1)
+        x ^= flip
+        y ^= flip
+        swap = (x ^ y) & (ry - 1)
+        x ^= swap
+        y ^= swap
+    return d
+
+
+# Morton(Z階数)曲線に沿った番号、xとyのビットを交互に並べたもの
+def morton_index(x, y, order=CURVE_ORDER):
+    d = np.zeros(len(x), dtype=np.int64)
+    for bit in range(order):
+        d |= ((x >> bit) & 1) << (2 * bit)
+        d |= ((y >> bit) & 1) << (2 * bit + 1)
+    return d
+
+
+# 都市を空間充填曲線に沿って並べた都市リストを返す
+# 座標だけから番号を計算して並べ替えるだけなので、距離行列は使わずO(N log N)で終わる(100万都市で1秒くらい)
+# 貪欲法より25%ほど長くなるが、opt2やOr-opt、焼きなましの最初の都市リストにはそれで十分
+# |cities|: 都市のx座標とy座標のリスト(N x 2の配列でもよい)
+# |start_city|: 最初に訪問する都市番号
+# |curve|: 'hilbert'か'morton'、Hilbert曲線の方が隣の番号の都市が必ず近いので短くなる
+# 返り値の都市リストは最初の都市に戻ってこない(長さN)
+@profiler.timed('construction')
+def space_filling_curve_tour(cities, start_city: int = 0, curve: str = 'hilbert') -> list[int]:
+    xy = np.asarray(cities, dtype=np.float64).reshape(-1, 2)
+    if len(xy) == 0:
+        return []
+    x, y = _grid_coordinates(xy, CURVE_ORDER)
+    index = hilbert_index(x, y) if curve == 'hilbert' else morton_index(x, y)
+    order = np.argsort(index, kind='stable')
+    k = int(np.flatnonzero(order == start_city)[0])
+    return np.concatenate([order[k:], order[:k]]).tolist()
+
+
+def hilbert_tour(cities, start_city: int = 0) -> list[int]:
+    return space_filling_curve_tour(cities, start_city, 'hilbert')
+
+
+def morton_tour(cities, start_city: int = 0) -> list[int]:
+    return space_filling_curve_tour(cities, start_city, 'morton')
+
+
+# 近傍リストから、長さが同じ辺を一つずつにした候補の辺(i < j)の配列i, jと長さを返す
+def _candidate_edges(xy, k):
+    N = len(xy)
+    neighbors = k_nearest_neighbors(xy, k)
+    i = np.repeat(np.arange(N), neighbors.shape[1])
+    j = neighbors.ravel()
+    key = np.sort(np.minimum(i, j) * N + np.maximum(i, j))
+    key = key[np.append(True, key[1:] != key[:-1])]
+    i, j = key // N, key % N
+    diff = xy[i] - xy[j]
+    return i, j, np.hypot(diff[:, 0], diff[:, 1])
+
+
+# 候補の辺を順番に見て、両端の次数が2未満で閉路にならない辺だけを採用する
+# 閉路になるかどうかはUnion-Findで調べる、採用した辺は都市ごとの隣の都市adjに入れる
+# 返り値のadjは、まだ端になっている都市では-1が残っている
+def _add_edges(N, edges_i, edges_j):
+    parent = list(range(N))
+    adj = [[-1, -1] for _ in range(N)]
+
+    def find(a):
+        while parent[a] != a:
+            parent[a] = parent[parent[a]]
+            a = parent[a]
+        return a
+
+    added = 0
+    for a, b in zip(edges_i, edges_j):
+        if adj[a][1] >= 0 or adj[b][1] >= 0:
+            continue
+        ra, rb = find(a), find(b)
+        if ra == rb:
+            continue
+        parent[ra] = rb
+        adj[a][adj[a][0] >= 0] = b
+        adj[b][adj[b][0] >= 0] = a
+        added += 1
+        # N - 1本で一本の道になるので、それ以上は足せない
+        if added == N - 1:
+            break
+    return adj
+
+
+# _add_edgesでできた道(1都市だけのものも含む)の端同士を、貪欲辺法と同じく短い辺から繋いでいく
+# 候補は道の端だけのk近傍の辺なので、近傍リストの外にある端同士も繋げる
+# 繋ぐたびに端が減るので、辺を足せなくなるか道が一本になるまで、残った端で近傍を作り直して繰り返す
+# adjをその場で書き換える、最後に残った道は_join_pathsで一周にする
+def _match_ends(xy, adj, k):
+    N = len(xy)
+    # 道の端 -> 反対側の端(1都市だけの道では自分自身)
+    other_end = {}
+    for c in range(N):
+        if adj[c][1] >= 0 or c in other_end:
+            continue
+        prev, current = -1, c
+        while True:
+            nxt = adj[current][0] if adj[current][0] != prev else adj[current][1]
+            if nxt < 0:
+                break
+            prev, current = current, nxt
+        other_end[c] = current
+        other_end[current] = c
+
+    while True:
+        ends = np.array([c for c in other_end if adj[c][1] < 0], dtype=np.int64)
+        if len(ends) <= 2:
+            return
+        i, j, length = _candidate_edges(xy[ends], min(k, len(ends) - 1))
+        order = np.argsort(length, kind='stable')
+        added = 0
+        for a, b in zip(ends[i[order]].tolist(), ends[j[order]].tolist()):
+            # 同じ道の両端を繋ぐと閉路になる
+            if adj[a][1] >= 0 or adj[b][1] >= 0 or other_end[a] == b:
+                continue
+            adj[a][adj[a][0] >= 0] = b
+            adj[b][adj[b][0] >= 0] = a
+            end_a, end_b = other_end.pop(a), other_end.pop(b)
+            if adj[a][1] < 0:
+                other_end[a] = a
+            if adj[b][1] < 0:
+                other_end[b] = b
+            other_end[end_a] = end_b
+            other_end[end_b] = end_a
+            added += 1
+        if not added:
+            return
+
+
+# _add_edgesでできた道(1都市だけのものも含む)を、端から一番近い別の道の端へ繋いでいって一周にし、
+# start_cityから始まる都市リストを返す
+# 道の端は訪れていない道の端だけを入れたDynamicCityGridで探す
+def _join_paths(xy, adj, start_city):
+    N = len(xy)
+    ends = [c for c in range(N) if adj[c][1] < 0]
+
+    # 道の端 -> 反対側の端
+    other_end = {}
+    for c in ends:
+        if c in other_end:
+            continue
+        prev, current = -1, c
+        while True:
+            nxt = adj[current][0] if adj[current][0] != prev else adj[current][1]
+            if nxt < 0:
+                break
+            prev, current = current, nxt
+        other_end[c] = current
+        other_end[current] = c
+
+    grid = DynamicCityGrid(xy[ends])
+    slot = {c: k for k, c in enumerate(ends)}
+
+    def remove_path(c):
+        grid.remove(slot[c])
+        if other_end[c] != c:
+            grid.remove(slot[other_end[c]])
+
+    first = ends[0]
+    remove_path(first)
+    last = other_end[first]
+    while grid.remaining:
+        nxt = ends[grid.nearest(xy[last, 0], xy[last, 1])]
+        remove_path(nxt)
+        adj[last][adj[last][0] >= 0] = nxt
+        adj[nxt][adj[nxt][0] >= 0] = last
+        last = other_end[nxt]
+    adj[last][adj[last][0] >= 0] = first
+    adj[first][adj[first][0] >= 0] = last
+
+    # start_cityから隣をたどって一周する
+    tour = [start_city]
+    prev, current = adj[start_city][1], start_city
+    for _ in range(N - 1):
+        nxt = adj[current][0] if adj[current][0] != prev else adj[current][1]
+        tour.append(nxt)
+        prev, current = current, nxt
+    return tour
+
+
+# 貪欲辺法(greedy edge)で都市リストを作る
+# 近傍リストの辺を短い順に、どの都市も次数2以下で閉路ができない限り足していき、残った道の端同士を繋ぐ
+# 距離行列は使わない、最近傍法より input_5 で5%、input_6 で8%、一様な乱数の10万都市で8%ほど短い都市リストになる
+# (最適な巡回路より14%ほど長い、kを10より大きくしても短くならない)
+# |cities|: 都市のx座標とy座標のリスト(N x 2の配列でもよい)
+# |start_city|: 最初に訪問する都市番号
+# |k|: 候補にする近傍の数
+# 返り値の都市リストは最初の都市に戻ってこない(長さN)
+@profiler.timed('construction')
+def greedy_edge_tour(cities, start_city: int = 0, k: int = NUM_NEIGHBORS) -> list[int]:
+    xy = np.asarray(cities, dtype=np.float64).reshape(-1, 2)
+    N = len(xy)
+    if N < 4:
+        return [(start_city + i) % N for i in range(N)]
+    i, j, length = _candidate_edges(xy, k)
+    order = np.argsort(length, kind='stable')
+    adj = _add_edges(N, i[order].tolist(), j[order].tolist())
+    _match_ends(xy, adj, k)
+    return _join_paths(xy, adj, start_city)
+
+
+# Clarke-Wrightのsavings法で都市リストを作る
+# 中心に一番近い都市hubから全部の都市へ往復する巡回路から始めて、i->hub->j を i->j に短絡したときに
+# 短くなる量 d(hub, i) + d(hub, j) - d(i, j) が大きい辺から、貪欲辺法と同じ条件で足していく
+# 候補は近傍リストの辺だけなので距離行列は使わない、input_5とinput_6では貪欲辺法より2-7%短いが、一様な乱数の10万都市では少し長い
+# |cities|: 都市のx座標とy座標のリスト(N x 2の配列でもよい)
+# |start_city|: 最初に訪問する都市番号
+# |k|: 候補にする近傍の数
+# 返り値の都市リストは最初の都市に戻ってこない(長さN)
+@profiler.timed('construction')
+def savings_tour(cities, start_city: int = 0, k: int = NUM_NEIGHBORS) -> list[int]:
+    xy = np.asarray(cities, dtype=np.float64).reshape(-1, 2)
+    N = len(xy)
+    if N < 4:
+        return [(start_city + i) % N for i in range(N)]
+    from_center = xy - xy.mean(axis=0)
+    hub = int(np.argmin(np.hypot(from_center[:, 0], from_center[:, 1])))
+    to_hub = np.hypot(*(xy - xy[hub]).T)
+
+    i, j, length = _candidate_edges(xy, k)
+    keep = (i != hub) & (j != hub)
+    i, j, length = i[keep], j[keep], length[keep]
+    savings = to_hub[i] + to_hub[j] - length
+    order = np.argsort(-savings, kind='stable')
+    adj = _add_edges(N, i[order].tolist(), j[order].tolist())
+    _match_ends(xy, adj, k)
+    return _join_paths(xy, adj, start_city)
+
+
+# 最初の都市リストの作り方の名前 -> (cities, start_city)から都市リストを返す関数
+CONSTRUCTIONS = {
+    'greedy': nearest_neighbor_tour,
+    'greedy_edge': greedy_edge_tour,
+    'savings': savings_tour,
+    'hilbert': hilbert_tour,
+    'morton': morton_tour,
+}
+# 出発都市によって都市リストが(回転を除いて)変わる作り方
+START_DEPENDENT = ('greedy',)
+
+
+# 名前で選んだ作り方で、最初の都市に戻ってこない都市リストを作る
+def construct_tour(cities, start_city: int = 0, method: str = 'greedy') -> list[int]:
+    if method not in CONSTRUCTIONS:
+        raise ValueError(f'unknown construction {method!r}, choose from {", ".join(CONSTRUCTIONS)}')
+    return CONSTRUCTIONS[method](cities, start_city)
+
+
+if __name__ == '__main__':
+    assert len(sys.argv) > 1
+    method = sys.argv[2] if len(sys.argv) > 2 else 'greedy'
+    print_tour(construct_tour(read_input(sys.argv[1]), 0, method))
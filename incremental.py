@@ -0,0 +1,170 @@
+#!/usr/bin/env python3
+
+import argparse
+import math
+import time
+
+import numpy as np
+
+from common import DistanceOracle, read_cities, read_tour, write_cities, write_tour
+from neighbors import CityGrid
+from profiling import profiler
+from solver_lk import LinKernighan
+
+# 近傍リストで使う近傍の数
+NUM_NEIGHBORS = 8
+# 新しい都市を入れる辺を探すときに調べる、近くの都市の数
+INSERTION_CANDIDATES = 8
+# 局所探索で調べる都市の数の上限(変わった都市1つあたり)、元の都市リストが局所最適でなくても全体に広がらない
+REPAIR_LIMIT = 20
+
+
+class _LazyNeighbors:
+    """
+    The _LazyNeighbors class is a neighbor list that computes the nearest cities
+    of a city the first time it is accessed as neighbors[city].
+
+    Local search after a small change only looks at the cities around the change,
+    so computing the neighbors of every city would cost more than the search itself.
+    The nearest cities are looked up in a CityGrid, widening the window of cells
+    around the city until it certainly holds the k nearest, as k_nearest_neighbors does.
+    """
+
+    def __init__(self, xy, k):
+        self.xy = xy
+        self.k = min(k, len(xy) - 1)
+        self.grid = CityGrid(xy, cities_per_cell=max(2.0, self.k / 4))
+        self.cache = {}
+
+    def __getitem__(self, city):
+        row = self.cache.get(city)
+        if row is None:
+            row = self.cache[city] = self.nearest(city)
+        return row
+
+    def nearest(self, city):
+        grid, k = self.grid, self.k
+        cx, cy = (int(c) for c in grid.cell_of(self.xy[city]))
+        r = 1
+        while True:
+            x0, y0, x1, y1 = cx - r, cy - r, cx + r, cy + r
+            candidates = grid.cities_in_window(x0, y0, x1, y1)
+            candidates = candidates[candidates != city]
+            if len(candidates) >= k:
+                diff = self.xy[candidates] - self.xy[city]
+                d = np.hypot(diff[:, 0], diff[:, 1])
+                nearest = np.argpartition(d, k - 1)[:k]
+                # 窓の境界までの距離より近傍k個目の距離が短ければ、窓の外にもっと近い都市はない
+                if grid.covers_all(x0, y0, x1, y1) or d[nearest].max() <= r * grid.cell_size:
+                    return candidates[nearest[np.argsort(d[nearest], kind='stable')]].tolist()
+            r += 1
+
+
+# 都市リストから|removed|の都市を抜き、残った都市に0から番号を振り直す
+# 返り値は(残った都市の座標, 新しい番号の都市リスト, 抜いた都市の前後にあった都市の新しい番号の集合)
+def _remove_cities(xy, order, removed):
+    keep = np.ones(len(xy), dtype=bool)
+    keep[list(removed)] = False
+    new_index = np.full(len(xy), -1, dtype=np.int64)
+    new_index[keep] = np.arange(int(keep.sum()))
+
+    n = len(order)
+    touched = {order[i] for i in range(n)
+               if keep[order[i]] and (not keep[order[i - 1]] or not keep[order[(i + 1) % n]])}
+    order = new_index[[city for city in order if keep[city]]].tolist()
+    return xy[keep], order, set(new_index[list(touched)].tolist())
+
+
+# 都市cityを、都市リストの中で近くの都市に繋がる辺のうち、一番長さが増えない辺の間に入れる(最安挿入)
+# 都市リストに入っている都市はcityより小さい番号の都市だけ
+def _cheapest_insertion(xy, order, city, dist):
+    n = len(order)
+    if n < 2:
+        order.append(city)
+        return {city}
+
+    diff = xy[:city] - xy[city]
+    d = np.hypot(diff[:, 0], diff[:, 1])
+    k = min(INSERTION_CANDIDATES, n)
+    candidates = np.argpartition(d, k - 1)[:k] if k < n else np.arange(n)
+    pos = np.empty(city, dtype=np.int64)
+    pos[order] = np.arange(n)
+
+    best_cost, best_i = math.inf, 0
+    for i in pos[candidates].tolist():
+        # 候補の都市の前の辺と後ろの辺の両方を調べる
+        for j in (i - 1, i):
+            a, b = order[j], order[(j + 1) % n]
+            cost = dist[a][city] + dist[city][b] - dist[a][b]
+            if cost < best_cost:
+                best_cost, best_i = cost, j % n
+    order.insert(best_i + 1, city)
+    return {order[best_i], city, order[(best_i + 2) % (n + 1)]}
+
+
+# 最適化済みの都市リストに都市の追加と削除を反映し、変わったところの周りだけを局所探索で直した都市リストを返す
+# 追加した都市は最安挿入で入れ、削除した都市の前後と追加した都市の前後からLin-Kernighan法を始めるので、
+# 距離行列も全都市の近傍リストも作らず、数都市の変更なら都市数が多くても数十ミリ秒で終わる
+# |cities|: 今の都市のx座標とy座標のリスト(N x 2の配列でもよい)
+# |tour|: citiesの都市リスト(最後に出発都市に戻っていてもよい)
+# |added|: 追加する都市のx座標とy座標のリスト
+# |removed|: 削除する都市の(citiesでの)番号のリスト
+# |num_neighbors|: Lin-Kernighan法で都市ごとに調べる近傍の数
+# 返り値は(新しい都市の座標, 都市0から始まり都市0で終わる都市リスト)
+# 新しい都市の番号は、残った都市が元の順番のまま0から、追加した都市がその後ろに続く
+@profiler.timed('incremental')
+def update_tour(cities, tour, added=(), removed=(), num_neighbors=NUM_NEIGHBORS):
+    xy = np.asarray(cities, dtype=np.float64).reshape(-1, 2)
+    N = len(xy)
+    order = [int(city) for city in tour]
+    if len(order) > 1 and order[0] == order[-1]:
+        order.pop()
+    if len(order) != N or (N and not np.all(np.bincount(order, minlength=N) == 1)):
+        raise ValueError('the tour does not visit every city exactly once')
+    removed = set(int(city) for city in removed)
+    if any(city < 0 or city >= N for city in removed):
+        raise ValueError(f'a removed city is out of range 0..{N - 1}')
+
+    touched = set()
+    if removed:
+        xy, order, touched = _remove_cities(xy, order, removed)
+
+    added = np.asarray(added, dtype=np.float64).reshape(-1, 2)
+    first_added = len(xy)
+    xy = np.concatenate([xy, added])
+    dist = DistanceOracle(xy)
+    for city in range(first_added, len(xy)):
+        touched |= _cheapest_insertion(xy, order, city, dist)
+    profiler.count('incremental.added', len(added))
+    profiler.count('incremental.removed', len(removed))
+
+    if not order:
+        return xy, []
+    if len(order) >= 5 and touched:
+        lk = LinKernighan(order, dist, _LazyNeighbors(xy, num_neighbors))
+        lk.optimize(sorted(touched), REPAIR_LIMIT * len(touched))
+        return xy, lk.tour(0)
+    k = order.index(0)
+    return xy, order[k:] + order[:k] + [0]
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description='Update an optimized tour after adding and removing cities, without solving it again.')
+    parser.add_argument('input_file', help='the current cities')
+    parser.add_argument('tour_file', help='the optimized tour of the current cities')
+    parser.add_argument('new_input_file', help='where to write the updated cities')
+    parser.add_argument('output_file', help='where to write the updated tour')
+    parser.add_argument('--add', default=None, help='file with the cities to add (same format as the input)')
+    parser.add_argument('--remove', type=int, nargs='*', default=[], help='indices of the cities to remove')
+    parser.add_argument('--neighbors', type=int, default=NUM_NEIGHBORS,
+                        help='number of nearest cities tried for each new edge')
+    args = parser.parse_args()
+
+    added = read_cities(args.add) if args.add else ()
+    start = time.perf_counter()
+    cities, tour = update_tour(read_cities(args.input_file), read_tour(args.tour_file), added, args.remove,
+                               args.neighbors)
+    print(f'{len(cities)} cities, {1000 * (time.perf_counter() - start):.1f} ms')
+    write_cities(cities, args.new_input_file)
+    write_tour(tour[:-1], args.output_file)
@@ -1,8 +1,15 @@
 #!/usr/bin/env python3
 
+import argparse
 import random
 
+import numpy as np
+
+from common import write_cities
+
 CHALLENGE_SIZES = (5, 8, 16, 64, 128, 512, 2048)
+# generateで作れる都市の配置
+LAYOUTS = ('uniform', 'clustered', 'grid', 'gaussian')
 
 
 def generate_cities(n, max_x=1600.0, max_y=900.0, seed=1):
@@ -11,6 +18,50 @@ def generate_cities(n, max_x=1600.0, max_y=900.0, seed=1):
         yield random.uniform(0, max_x), random.uniform(0, max_y)
 
 
+# n都市の座標を(n, 2)の配列としてNumPyの乱数でまとめて作る、同じseedなら同じ都市になる
+# |layout|: 都市の配置
+#   uniform   - 一様に散らばる
+#   clustered - 一様に置いた中心(約100都市に1つ)の周りに正規分布で集まる(DIMACSの課題と同じ作り方)
+#   grid      - 格子点に並ぶ(同じ長さの辺がたくさんある)
+#   gaussian  - 重みと広がりがばらばらな数個の正規分布を混ぜたもの(密な所と疎な所がある)
+# |clusters|: clusteredとgaussianの中心の数、Noneならclusteredはn / 100個、gaussianは8個
+def generate(n, layout='uniform', seed=1, max_x=1600.0, max_y=900.0, clusters=None):
+    rng = np.random.default_rng(seed)
+    size = np.array([max_x, max_y])
+
+    if layout == 'uniform':
+        return rng.random((n, 2)) * size
+
+    if layout == 'clustered':
+        k = clusters or max(n // 100, 1)
+        centers = rng.random((k, 2)) * size
+        sigma = max(max_x, max_y) / np.sqrt(max(n, 1))
+        xy = centers[rng.integers(k, size=n)] + rng.normal(0.0, sigma, (n, 2))
+
+    elif layout == 'grid':
+        # 縦横の比をmax_x : max_yに合わせた格子の点を左下から順に使う
+        width = max(int(np.ceil(np.sqrt(n * max_x / max_y))), 1)
+        height = max(-(-n // width), 1)
+        index = np.arange(n)
+        xy = np.column_stack([index % width * (max_x / width), index // width * (max_y / height)])
+        return xy
+
+    elif layout == 'gaussian':
+        k = clusters or 8
+        centers = rng.random((k, 2)) * size
+        weights = rng.dirichlet(np.ones(k))
+        sigmas = rng.uniform(0.02, 0.15, k) * max(max_x, max_y)
+        component = rng.choice(k, size=n, p=weights)
+        xy = centers[component] + rng.normal(0.0, 1.0, (n, 2)) * sigmas[component, None]
+
+    else:
+        raise ValueError(f'unknown layout {layout!r}, choose from {", ".join(LAYOUTS)}')
+
+    # 範囲の外に出た都市は端で折り返す(端に寄せると同じ座標の都市ができてしまう)
+    xy = size - np.abs(size - np.abs(xy))
+    return np.clip(xy, 0.0, size)
+
+
 def main():
     for i, n in enumerate(CHALLENGE_SIZES):
         with open(f'input_{i}.csv', 'w') as f:
@@ -20,4 +71,22 @@ def main():
 
 
 if __name__ == '__main__':
-    main()
+    parser = argparse.ArgumentParser(
+        description='Generate cities. Without arguments, write the challenge inputs input_0.csv ... input_6.csv.')
+    parser.add_argument('num_cities', type=int, nargs='?')
+    parser.add_argument('output_file', nargs='?', help='.csv, or .npy for the binary format')
+    parser.add_argument('--layout', choices=LAYOUTS, default='uniform')
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--clusters', type=int, default=None,
+                        help='number of centers for the clustered and gaussian layouts')
+    parser.add_argument('--width', type=float, default=1600.0)
+    parser.add_argument('--height', type=float, default=900.0)
+    args = parser.parse_args()
+
+    if args.num_cities is None:
+        main()
+    elif args.output_file is None:
+        parser.error('give the output file')
+    else:
+        cities = generate(args.num_cities, args.layout, args.seed, args.width, args.height, args.clusters)
+        write_cities(cities, args.output_file)
@@ -0,0 +1,167 @@
+#!/usr/bin/env python3
+
+import argparse
+import time
+
+import numpy as np
+
+from common import read_cities, read_tour
+from construction import nearest_neighbor_tour
+from profiling import profiler
+
+# 部分勾配法でペナルティを更新する回数の上限
+HELD_KARP_ITERATIONS = 100
+# この回数続けて下界が良くならなかったら、ステップの大きさを半分にする
+HELD_KARP_PATIENCE = 5
+# --target-gapのためにソルバーが下界を求める都市の数の上限(1-木一つがO(N^2)で、5000都市で約1秒)
+MAX_TARGET_BOUND_CITIES = 5000
+# --target-gapのためにソルバーが下界を求める時間の上限(秒)、途中で止めても下界であることは変わらない
+TARGET_BOUND_TIME_LIMIT = 10.0
+
+
+# 都市0を特別な都市とした最小1-木の、ペナルティpiを引いた長さと、それぞれの都市の次数を返す
+# 1-木は都市1..N-1の最小全域木に、都市0から一番近い2都市への辺を加えたもので、
+# 巡回路も1-木の一つなので、どんなpiでも 長さ - 2 * sum(pi) は最適な巡回路の長さ以下になる
+# 辺(i, j)の長さは d(i, j) + pi[i] + pi[j] とし、Prim法で距離行列を作らずに座標から計算する(O(N^2)時間、O(N)メモリ)
+# |xy|: N x 2の都市の座標(N >= 3)
+# |pi|: 長さNのペナルティの配列
+def minimum_one_tree(xy, pi):
+    N = len(xy)
+    x, y = xy[:, 0].copy(), xy[:, 1].copy()
+    # 木に入った都市はoffsetをinfにして、keyが更新されないようにする
+    offset = pi.copy()
+    offset[:2] = np.inf
+    degree = np.zeros(N, dtype=np.int64)
+
+    # key[v]は木に入っている都市からvへの一番短い辺の長さ、parent[v]はその辺のもう一方の端
+    key = np.hypot(x - x[1], y - y[1]) + offset + pi[1]
+    parent = np.ones(N, dtype=np.int64)
+    d = np.empty(N)
+    dy = np.empty(N)
+    closer = np.empty(N, dtype=bool)
+    length = 0.0
+    for _ in range(N - 2):
+        v = int(np.argmin(key))
+        length += key[v]
+        degree[v] += 1
+        degree[parent[v]] += 1
+        offset[v] = np.inf
+        key[v] = np.inf
+
+        np.subtract(x, x[v], out=d)
+        np.subtract(y, y[v], out=dy)
+        np.hypot(d, dy, out=d)
+        d += offset
+        d += pi[v]
+        np.less(d, key, out=closer)
+        np.minimum(d, key, out=key)
+        np.putmask(parent, closer, v)
+
+    # 特別な都市0から一番近い2都市への辺
+    diff = xy[1:] - xy[0]
+    d = np.hypot(diff[:, 0], diff[:, 1]) + pi[1:] + pi[0]
+    nearest = np.argpartition(d, 1)[:2]
+    length += d[nearest].sum()
+    degree[0] = 2
+    degree[nearest + 1] += 1
+    return length - 2 * pi.sum(), degree
+
+
+# 最小1-木のHeld-Karp下界を部分勾配法で求めて返す、最適な巡回路の長さはこの値以上になる
+# 次数が2より大きい都市のペナルティを上げ、2より小さい都市のペナルティを下げることを繰り返すと、
+# 1-木が巡回路に近づき下界が上がる(一様な乱数の都市では最適値の1%ほど下まで上がる)
+# 1-木一つにO(N^2)かかるので、数千都市までを想定している
+# |cities|: 都市のx座標とy座標のリスト(N x 2の配列でもよい)
+# |upper_bound|: 巡回路の長さ(ステップの大きさに使う)、Noneなら貪欲法の巡回路の長さ
+# |iterations|: ペナルティを更新する回数の上限(1より小さくても、ペナルティなしの1-木を一つは求める)
+# |time_limit|: 秒、Noneなら時間では止めない
+@profiler.timed('lower_bound')
+def held_karp_bound(cities, upper_bound=None, iterations=HELD_KARP_ITERATIONS, time_limit=None):
+    xy = np.asarray(cities, dtype=np.float64).reshape(-1, 2)
+    N = len(xy)
+    if N < 3:
+        return 2 * float(np.hypot(*(xy[-1] - xy[0]))) if N == 2 else 0.0
+
+    if upper_bound is None:
+        tour = nearest_neighbor_tour(xy, 0)
+        diff = xy[tour] - xy[np.roll(tour, -1)]
+        upper_bound = float(np.hypot(diff[:, 0], diff[:, 1]).sum())
+
+    deadline = None if time_limit is None else time.time() + time_limit
+    pi = np.zeros(N)
+    best = -np.inf
+    step = 2.0
+    since_improved = 0
+    completed = 0
+    for _ in range(max(iterations, 1)):
+        bound, degree = minimum_one_tree(xy, pi)
+        completed += 1
+        if bound > best:
+            best = bound
+            since_improved = 0
+        else:
+            since_improved += 1
+            if since_improved >= HELD_KARP_PATIENCE:
+                step /= 2
+                since_improved = 0
+
+        # すべての次数が2なら1-木が巡回路になっていて、下界が最適値に一致する
+        subgradient = degree - 2
+        norm = float((subgradient * subgradient).sum())
+        if norm == 0 or (deadline is not None and time.time() >= deadline):
+            break
+        pi += step * max(upper_bound - bound, 0.0) / norm * subgradient
+    profiler.count('lower_bound.iterations', completed)
+    return float(best)
+
+
+# 巡回路の長さが下界よりどれだけ長いか(最適値との差の上限)を割合で返す
+def gap(length, bound):
+    return length / bound - 1 if bound > 0 else float('inf')
+
+
+# target_gapが指定されていて、巡回路の長さが下界のtarget_gap以内に入ったらTrue
+def gap_reached(length, bound, target_gap):
+    return target_gap is not None and bound is not None and gap(length, bound) <= target_gap
+
+
+# ソルバーが--target-gapのために使う下界を返す、target_gapがNoneのときや都市が多すぎるときはNone
+# 最初の出発都市を待たせすぎないように、TARGET_BOUND_TIME_LIMIT秒で打ち切る
+# |upper_bound|: 巡回路の長さ(分かっていれば)
+def target_bound(cities, target_gap, upper_bound=None):
+    N = len(cities)
+    if target_gap is None or N < 3:
+        return None
+    if N > MAX_TARGET_BOUND_CITIES:
+        print(f'no lower bound for --target-gap: {N} cities is more than {MAX_TARGET_BOUND_CITIES}')
+        return None
+    return held_karp_bound(cities, upper_bound, time_limit=TARGET_BOUND_TIME_LIMIT)
+
+
+# ソルバーのargparseに目標のギャップのオプションを加える
+def add_arguments(parser):
+    parser.add_argument('--target-gap', type=float, default=None,
+                        help='stop as soon as the tour is within this fraction of the Held-Karp lower bound '
+                             '(e.g. 0.05 for 5%%)')
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Print the Held-Karp lower bound, and the gap of a tour to it.')
+    parser.add_argument('input_file')
+    parser.add_argument('tour_file', nargs='?')
+    parser.add_argument('--iterations', type=int, default=HELD_KARP_ITERATIONS)
+    parser.add_argument('--time-limit', type=float, default=None)
+    args = parser.parse_args()
+    if args.iterations < 1:
+        parser.error('--iterations must be at least 1')
+
+    cities = read_cities(args.input_file)
+    length = None
+    if args.tour_file:
+        tour = np.asarray(read_tour(args.tour_file))
+        diff = cities[tour] - cities[np.roll(tour, -1)]
+        length = float(np.hypot(diff[:, 0], diff[:, 1]).sum())
+    bound = held_karp_bound(cities, length, args.iterations, args.time_limit)
+    print(f'lower bound: {bound:.2f}')
+    if length is not None:
+        print(f'tour: {length:.2f}, gap: {100 * gap(length, bound):.2f} %')
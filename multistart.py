@@ -0,0 +1,161 @@
+#!/usr/bin/env python3
+
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from multiprocessing import shared_memory
+
+import numpy as np
+
+from common import DistanceOracle, PackedDistanceMatrix
+from lower_bound import gap, gap_reached
+from profiling import profiler
+
+
+# 最初と最後が同じ都市の都市リストの総合距離を返す
+def tour_length(tour, dist):
+    total = 0
+    for i in range(len(tour) - 1):
+        total += dist[tour[i]][tour[i + 1]]
+    return total
+
+
+class SharedDistanceMatrix:
+    """
+    The SharedDistanceMatrix class copies a distance matrix into shared memory once,
+    so that worker processes can attach to it by name instead of receiving a pickled
+    N x N matrix with every task.
+
+    A nested-list matrix is shared as a float64 array and turned back into lists
+    in each worker, because the solvers read it one element at a time and that is
+    much faster on lists. A PackedDistanceMatrix shares only its flat data.
+    A DistanceOracle has no matrix to share, so it is sent to the workers as is
+    (only its coordinates are pickled).
+
+    Attributes:
+        shm (SharedMemory): The shared memory block that holds the matrix.
+        array (np.ndarray): The matrix (or the packed data) viewed on top of the shared memory block.
+        kind (str): 'list', 'array' or 'packed', how the workers should see the matrix.
+        num_cities (int): Number of cities.
+        oracle (DistanceOracle): The oracle given instead of a matrix, or None.
+    """
+
+    def __init__(self, dist):
+        self.oracle = dist if isinstance(dist, DistanceOracle) else None
+        self.shm = None
+        if self.oracle is not None:
+            return
+        self.num_cities = len(dist)
+        if isinstance(dist, PackedDistanceMatrix):
+            self.kind = 'packed'
+            dist = dist.data
+        else:
+            self.kind = 'list' if isinstance(dist, list) else 'array'
+            dist = np.ascontiguousarray(dist)
+        self.shm = shared_memory.SharedMemory(create=True, size=max(dist.nbytes, 1))
+        self.array = np.ndarray(dist.shape, dtype=dist.dtype, buffer=self.shm.buf)
+        self.array[...] = dist
+
+    def handle(self):
+        """
+        Returns what a worker needs to attach to the matrix: (kind, name, shape, dtype, num_cities),
+        or the oracle itself.
+        """
+        if self.oracle is not None:
+            return self.oracle
+        return self.kind, self.shm.name, self.array.shape, self.array.dtype.str, self.num_cities
+
+    def close(self):
+        """
+        Releases and removes the shared memory block.
+        """
+        if self.shm is None:
+            return
+        self.array = None
+        self.shm.close()
+        self.shm.unlink()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+# ワーカープロセスごとの状態(initializerで一度だけ設定する)
+_worker = {}
+
+
+# ワーカープロセスからSharedDistanceMatrixにつなぎ、元と同じ持ち方の距離行列として返す
+# np.ndarrayとPackedDistanceMatrixは共有メモリをコピーせずに参照し、入れ子のリストはワーカーごとに作り直す
+# |handle|: SharedDistanceMatrix.handle()の返り値
+def attach_distance_matrix(handle):
+    if isinstance(handle, DistanceOracle):
+        return handle
+    kind, name, shape, dtype, num_cities = handle
+    # shmが消えると行列も読めなくなるので、ワーカーが終わるまで持っておく
+    shm = shared_memory.SharedMemory(name=name)
+    _worker['shm'] = shm
+    array = np.ndarray(shape, dtype=dtype, buffer=shm.buf)
+    if kind == 'packed':
+        return PackedDistanceMatrix.from_data(num_cities, array)
+    if kind == 'list':
+        return array.tolist()
+    return array
+
+
+def _init_worker(handle, job, cities, args):
+    _worker['dist'] = attach_distance_matrix(handle)
+    _worker['job'] = job
+    _worker['cities'] = cities
+    _worker['args'] = args
+
+
+def _run_start(start_city):
+    dist = _worker['dist']
+    tour = _worker['job'](_worker['cities'], dist, start_city, *_worker['args'])
+    return start_city, tour, tour_length(tour, dist)
+
+
+# start_citiesのそれぞれから job(cities, dist, start_city, *args) を実行し、
+# 終わったものから (start_city, tour, 総合距離) を返していくジェネレータ
+# |job|: 出発都市から都市リストを作る関数(ワーカーに渡せるようにモジュールの一番外で定義したもの)
+# |dist|: build_distance_matrixの返り値、workersが2以上のときは共有メモリに一度だけコピーしてワーカーから参照する
+# |workers|: プロセスの数、1ならこのプロセスで順番に実行し、Noneならすべてのコアを使う
+# |args|: jobに渡す残りの引数(ワーカーごとに一度だけ送られる)
+def multistart(job, cities, dist, start_cities, workers=1, args=()):
+    if workers == 1:
+        for start_city in start_cities:
+            tour = job(cities, dist, start_city, *args)
+            yield start_city, tour, tour_length(tour, dist)
+        return
+
+    with SharedDistanceMatrix(dist) as shared:
+        with ProcessPoolExecutor(max_workers=workers, initializer=_init_worker,
+                                 initargs=(shared.handle(), job, cities, args)) as pool:
+            futures = [pool.submit(_run_start, start_city) for start_city in start_cities]
+            try:
+                for future in as_completed(futures):
+                    yield future.result()
+            finally:
+                for future in futures:
+                    future.cancel()
+
+
+# multistartの結果から一番短い都市リストを選んで (tour, 総合距離) を返す
+# 同じ距離なら出発都市の番号が小さい方を選ぶので、workersの数によらず同じ結果になる
+# |verbose|: Trueなら結果が返ってくるたびに出発都市と総合距離(boundがあれば下界とのギャップも)を表示する
+# |bound|: lower_bound.target_boundで求めた下界、Noneならギャップを表示せず止めない
+# |target_gap|: 一番短い都市リストが下界のtarget_gap以内に入ったら、残りの出発都市を試さずに止める
+def best_of_multistart(results, verbose=True, bound=None, target_gap=None):
+    best = None
+    for start_city, tour, length in results:
+        if verbose:
+            print(start_city, length, *([f'{100 * gap(length, bound):.2f}%'] if bound else []))
+        if best is None or (length, start_city) < (best[2], best[0]):
+            best = (start_city, tour, length)
+            profiler.trace('multistart', length)
+            if gap_reached(length, bound, target_gap):
+                break
+    # 途中で止めたときは、まだ始まっていない出発都市を取り消す
+    if hasattr(results, 'close'):
+        results.close()
+    return best[1], best[2]
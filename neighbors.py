@@ -0,0 +1,239 @@
+#!/usr/bin/env python3
+
+import sys
+
+import numpy as np
+
+from common import read_input
+from profiling import profiler
+
+# 近傍リストで使うデフォルトの近傍の数
+NUM_NEIGHBORS = 10
+
+
+# width x heightの範囲にN都市を入れるグリッドのセルの一辺の長さを返す
+# 面積から決めるとセル1つに平均cities_per_cell都市になるが、都市が一直線に並んでいると面積がほぼ0になり、
+# セルが小さくなりすぎて数が爆発するので、長い方の辺をN / cities_per_cell個に分けた長さより小さくしない
+def cell_size_for(width, height, N, cities_per_cell):
+    N = max(N, 1)
+    by_area = (max(width, 1e-9) * max(height, 1e-9) * cities_per_cell / N) ** 0.5
+    by_side = max(width, height) * cities_per_cell / N
+    return max(by_area, by_side, 1e-9)
+
+
+class CityGrid:
+    """
+    The CityGrid class buckets cities into a uniform grid so that nearby cities
+    can be found without looking at every city.
+
+    The cities are sorted by cell, and the cities of the cell (cx, cy) are
+    order[cell_start[cy * width + cx]: cell_start[cy * width + cx + 1]].
+
+    Attributes:
+        xy (np.ndarray): N x 2 array of the coordinates of the cities.
+        cell_size (float): Length of a side of a cell.
+        width (int): Number of cells in the x direction.
+        height (int): Number of cells in the y direction.
+        order (np.ndarray): City indices sorted by cell.
+        cell_start (np.ndarray): Start of each cell in order (size width * height + 1).
+    """
+
+    def __init__(self, xy, cities_per_cell=2.0):
+        self.xy = xy
+        N = len(xy)
+        self.min_x, self.min_y = xy.min(axis=0) if N else (0.0, 0.0)
+        max_x, max_y = xy.max(axis=0) if N else (0.0, 0.0)
+        self.cell_size = cell_size_for(max_x - self.min_x, max_y - self.min_y, N, cities_per_cell)
+        self.width = int((max_x - self.min_x) / self.cell_size) + 1
+        self.height = int((max_y - self.min_y) / self.cell_size) + 1
+
+        self.cell_x, self.cell_y = self.cell_of(xy)
+        cell = self.cell_y * self.width + self.cell_x
+        self.order = np.argsort(cell, kind='stable')
+        counts = np.bincount(cell, minlength=self.width * self.height)
+        self.cell_start = np.zeros(self.width * self.height + 1, dtype=np.int64)
+        np.cumsum(counts, out=self.cell_start[1:])
+
+    def cell_of(self, xy):
+        """
+        Returns the (cx, cy) cell coordinates of the given points.
+        """
+        cx = ((xy[..., 0] - self.min_x) / self.cell_size).astype(np.int64)
+        cy = ((xy[..., 1] - self.min_y) / self.cell_size).astype(np.int64)
+        return np.clip(cx, 0, self.width - 1), np.clip(cy, 0, self.height - 1)
+
+    def cities_in_window(self, x0, y0, x1, y1):
+        """
+        Returns the cities in the cells x0..x1, y0..y1 (inclusive, clipped to the grid).
+        """
+        x0, y0 = max(x0, 0), max(y0, 0)
+        x1, y1 = min(x1, self.width - 1), min(y1, self.height - 1)
+        ranges = [self.order[self.cell_start[cy * self.width + x0]:
+                             self.cell_start[cy * self.width + x1 + 1]]
+                  for cy in range(y0, y1 + 1)]
+        return np.concatenate(ranges) if ranges else np.empty(0, dtype=np.int64)
+
+    def covers_all(self, x0, y0, x1, y1):
+        return x0 <= 0 and y0 <= 0 and x1 >= self.width - 1 and y1 >= self.height - 1
+
+
+class DynamicCityGrid:
+    """
+    The DynamicCityGrid class is a uniform grid of the remaining cities that supports
+    removing cities and finding the nearest remaining city to a point.
+
+    Each cell is a plain list, and a city is removed in O(1) by moving the last city
+    of its cell into its slot. When half of the cities have been removed, the grid is
+    rebuilt with bigger cells so that searches do not walk through many empty cells.
+
+    Attributes:
+        xs (list[float]): x-coordinates of all the cities.
+        ys (list[float]): y-coordinates of all the cities.
+        remaining (int): Number of cities that have not been removed.
+    """
+
+    def __init__(self, xy, cities_per_cell=2.0):
+        self.xs = xy[:, 0].tolist()
+        self.ys = xy[:, 1].tolist()
+        self.cities_per_cell = cities_per_cell
+        self.removed = [False] * len(self.xs)
+        self.remaining = len(self.xs)
+        self.rebuild(range(len(self.xs)))
+
+    def rebuild(self, cities):
+        """
+        Puts the given cities into a new grid sized for their number.
+        """
+        cities = list(cities)
+        xs = [self.xs[c] for c in cities]
+        ys = [self.ys[c] for c in cities]
+        self.min_x, self.min_y = min(xs, default=0.0), min(ys, default=0.0)
+        width = max(xs, default=0.0) - self.min_x
+        height = max(ys, default=0.0) - self.min_y
+        self.cell_size = cell_size_for(width, height, len(cities), self.cities_per_cell)
+        self.width = int(width / self.cell_size) + 1
+        self.height = int(height / self.cell_size) + 1
+        self.rebuild_at = len(cities) // 2
+
+        self.cells = [[] for _ in range(self.width * self.height)]
+        self.cell = {}
+        self.slot = {}
+        for c in cities:
+            cell = self.cell_index(self.xs[c], self.ys[c])
+            self.cell[c] = cell
+            self.slot[c] = len(self.cells[cell])
+            self.cells[cell].append(c)
+
+    def cell_xy(self, x, y):
+        cx = min(max(int((x - self.min_x) / self.cell_size), 0), self.width - 1)
+        cy = min(max(int((y - self.min_y) / self.cell_size), 0), self.height - 1)
+        return cx, cy
+
+    def cell_index(self, x, y):
+        cx, cy = self.cell_xy(x, y)
+        return cy * self.width + cx
+
+    def remove(self, city):
+        """
+        Removes the city from the grid.
+        """
+        cell = self.cells[self.cell.pop(city)]
+        slot = self.slot.pop(city)
+        last = cell.pop()
+        if last != city:
+            cell[slot] = last
+            self.slot[last] = slot
+        self.removed[city] = True
+        self.remaining -= 1
+
+        if self.remaining and self.remaining <= self.rebuild_at:
+            self.rebuild(self.cell.keys())
+
+    def nearest(self, x, y):
+        """
+        Returns the remaining city nearest to (x, y), or None if no city remains.
+        Ties are broken by the smaller city index.
+        """
+        if not self.remaining:
+            return None
+        xs, ys, cells, width = self.xs, self.ys, self.cells, self.width
+        # (x, y)がグリッドの外にあるときは一番近い端のセルから探す(それでも下の打ち切り条件は成り立つ)
+        cx, cy = self.cell_xy(x, y)
+        best, best_d2 = None, float('inf')
+
+        r = 0
+        while True:
+            # 中心のセルから距離rの輪になっているセルを調べる
+            y0, y1 = cy - r, cy + r
+            x0, x1 = max(cx - r, 0), min(cx + r, width - 1)
+            ring = []
+            for ry in (y0, y1) if r else (y0,):
+                if 0 <= ry < self.height:
+                    ring.extend(range(ry * width + x0, ry * width + x1 + 1))
+            for rx in (cx - r, cx + r) if r else ():
+                if 0 <= rx < width:
+                    ring.extend(ry * width + rx for ry in range(max(y0 + 1, 0), min(y1, self.height)))
+
+            for cell in ring:
+                for c in cells[cell]:
+                    dx = xs[c] - x
+                    dy = ys[c] - y
+                    d2 = dx * dx + dy * dy
+                    if d2 < best_d2 or (d2 == best_d2 and c < best):
+                        best, best_d2 = c, d2
+
+            # 輪の外の都市は r * cell_size より遠いので、それより近い都市が見つかっていれば終わり
+            margin = r * self.cell_size
+            if best is not None and best_d2 <= margin * margin:
+                return best
+            if r > max(width, self.height):
+                return best
+            r += 1
+
+
+# 都市ごとに近い順にk個の都市を返す(自分自身は含まない)
+# グリッドで近くのセルだけを調べるので、全体でO(N・k)程度で終わる
+# |cities|: 都市のx座標とy座標のリスト(N x 2の配列でもよい)
+# |k|: 近傍の数
+@profiler.timed('neighbors')
+def k_nearest_neighbors(cities, k=NUM_NEIGHBORS) -> np.ndarray:
+    xy = np.asarray(cities, dtype=np.float64).reshape(-1, 2)
+    N = len(xy)
+    k = min(k, N - 1)
+    neighbors = np.empty((N, max(k, 0)), dtype=np.int64)
+    if k <= 0:
+        return neighbors
+
+    grid = CityGrid(xy, cities_per_cell=max(2.0, k / 4))
+    for cell in np.flatnonzero(np.diff(grid.cell_start)):
+        members = grid.order[grid.cell_start[cell]: grid.cell_start[cell + 1]]
+        cx, cy = cell % grid.width, cell // grid.width
+
+        # 近傍k個がすべて調べた窓の中に入っていると言えるまで窓を広げる
+        r = 1
+        while True:
+            x0, y0, x1, y1 = cx - r, cy - r, cx + r, cy + r
+            candidates = grid.cities_in_window(x0, y0, x1, y1)
+            if len(candidates) > k:
+                diff = xy[members][:, None, :] - xy[candidates][None, :, :]
+                d = np.hypot(diff[..., 0], diff[..., 1])
+                d[members[:, None] == candidates[None, :]] = np.inf
+                nearest = np.argpartition(d, k - 1, axis=1)[:, :k]
+                nearest_d = np.take_along_axis(d, nearest, axis=1)
+
+                # 窓の境界までの距離より近傍k個目の距離が短ければ、窓の外にもっと近い都市はない
+                margin = r * grid.cell_size
+                if grid.covers_all(x0, y0, x1, y1) or nearest_d.max() <= margin:
+                    by_distance = np.argsort(nearest_d, axis=1)
+                    neighbors[members] = candidates[np.take_along_axis(nearest, by_distance, axis=1)]
+                    break
+            r += 1
+
+    return neighbors
+
+
+if __name__ == '__main__':
+    assert len(sys.argv) > 1
+    k = int(sys.argv[2]) if len(sys.argv) > 2 else NUM_NEIGHBORS
+    for city, row in enumerate(k_nearest_neighbors(read_input(sys.argv[1]), k)):
+        print(city, *row)
@@ -1,33 +1,127 @@
 #!/usr/bin/env python3
 
-import math
+import argparse
+import sys
+from concurrent.futures import ProcessPoolExecutor
 
-from common import read_input
+import numpy as np
+
+from common import read_cities, read_tour
 
 CHALLENGES = 7
+# 総合距離を計算するときに一度に座標を取り出す都市の数
+CHUNK_SIZE = 1 << 20
+
+
+# 都市リストがすべての都市を一度ずつ訪れているか確かめ、そうでなければValueError
+# 最後に出発都市に戻ってくる都市リスト(長さN + 1)も受け付けて、長さNの配列を返す
+def validate_tour(tour, N):
+    tour = np.asarray(tour)
+    try:
+        # .npyの都市リストが浮動小数点などのときは、整数に変えられなければ正しくない都市リストとする
+        tour = tour.astype(np.int64, casting='safe', copy=False)
+    except TypeError:
+        raise ValueError(f'the tour has {tour.dtype} entries, not city indices') from None
+    if tour.ndim != 1:
+        raise ValueError(f'the tour has shape {tour.shape}, not a list of cities')
+    if len(tour) == N + 1 and N > 0 and tour[0] == tour[-1]:
+        tour = tour[:-1]
+    if len(tour) != N:
+        raise ValueError(f'the tour has {len(tour)} cities, but the input has {N}')
+    if N and (tour.min() < 0 or tour.max() >= N):
+        raise ValueError(f'the tour has a city out of range 0..{N - 1}')
+    if N and not np.all(np.bincount(tour, minlength=N) == 1):
+        missing = int(np.flatnonzero(np.bincount(tour, minlength=N) == 0)[0])
+        raise ValueError(f'the tour does not visit city {missing}')
+    return tour
+
+
+# 都市を順番に回って出発都市に戻るまでの総合距離をNumPyで計算する
+# CHUNK_SIZE都市ずつ座標を取り出すので、100万都市でも都市リストと同じくらいのメモリしか使わない
+def tour_length(cities, tour, chunk_size=CHUNK_SIZE):
+    N = len(tour)
+    total = 0.0
+    for start in range(0, N, chunk_size):
+        # 次のチャンクの最初の都市(最後は出発都市)までの辺を含める
+        end = min(start + chunk_size, N)
+        index = np.append(tour[start: end], tour[end % N])
+        xy = cities[index]
+        diff = np.diff(xy, axis=0)
+        total += float(np.hypot(diff[:, 0], diff[:, 1]).sum())
+    return total
+
+
+# 入力ファイルと出力ファイルの組を確かめて、総合距離を返す
+# 出力ファイルはCSV(一行目がindex)か.npy、都市リストが正しくなければValueError
+def verify_tour(input_file, output_file):
+    if not output_file.endswith('.npy'):
+        with open(output_file) as f:
+            if f.readline().strip() != 'index':
+                raise ValueError(f'{output_file} does not start with "index"')
+    cities = read_cities(input_file, mmap=True)
+    tour = validate_tour(read_tour(output_file), len(cities))
+    return tour_length(cities, tour)
 
 
-def distance(city1, city2):
-    return math.sqrt((city1[0] - city2[0]) ** 2 + (city1[1] - city2[1]) ** 2)
+def _verify(pair):
+    input_file, output_file = pair
+    try:
+        return verify_tour(input_file, output_file), None
+    except (OSError, ValueError) as e:
+        return None, str(e)
 
 
-def verify_output():
+# (入力ファイル, 出力ファイル)の組をすべて確かめ、(総合距離, エラー)を同じ順番で返していく
+# |workers|: プロセスの数、1ならこのプロセスで順番に確かめ、Noneならすべてのコアを使う
+def verify_all(pairs, workers=1):
+    if workers == 1:
+        yield from map(_verify, pairs)
+        return
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        yield from pool.map(_verify, pairs)
+
+
+def verify_output(workers=1):
+    prefixes = ('output', 'sample/random', 'sample/greedy', 'sample/sa')
+    pairs = [(f'input_{challenge_number}.csv', f'{output_prefix}_{challenge_number}.csv')
+             for challenge_number in range(CHALLENGES) for output_prefix in prefixes]
+    results = list(verify_all(pairs, workers))
     for challenge_number in range(CHALLENGES):
         print(f'Challenge {challenge_number}')
-        cities = read_input(f'input_{challenge_number}.csv')
-        N = len(cities)
-        for output_prefix in ('output', 'sample/random', 'sample/greedy', 'sample/sa'):
-            output_file = f'{output_prefix}_{challenge_number}.csv'
-            with open(output_file) as f:
-                lines = f.readlines()
-                assert lines[0].strip() == 'index'
-                tour = [int(i.strip()) for i in lines[1:N + 1]]
-            assert set(tour) == set(range(N))
-            path_length = sum(distance(cities[tour[i]], cities[tour[(i + 1) % N]])
-                              for i in range(N))
+        for k, output_prefix in enumerate(prefixes):
+            path_length, error = results[challenge_number * len(prefixes) + k]
+            assert error is None, error
             print(f'{output_prefix:16}: {path_length:>10.2f}')
         print()
 
 
+def main():
+    parser = argparse.ArgumentParser(
+        description='Verify tours and print their lengths. Without files, verify the challenge outputs.')
+    parser.add_argument('files', nargs='*',
+                        help='pairs of an input file and a tour file: input_1.csv output_1.csv input_2.csv ...')
+    parser.add_argument('--workers', type=int, default=1,
+                        help='number of processes (0 uses every core)')
+    args = parser.parse_args()
+    workers = args.workers or None
+
+    if not args.files:
+        verify_output(workers)
+        return
+    if len(args.files) % 2:
+        parser.error('give the files as pairs of an input file and a tour file')
+
+    pairs = list(zip(args.files[::2], args.files[1::2]))
+    failed = False
+    for (input_file, output_file), (path_length, error) in zip(pairs, verify_all(pairs, workers)):
+        if error is None:
+            print(f'{output_file}: {path_length:.2f}')
+        else:
+            print(f'{output_file}: INVALID ({error})')
+            failed = True
+    if failed:
+        sys.exit(1)
+
+
 if __name__ == '__main__':
-    verify_output()
+    main()
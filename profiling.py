@@ -0,0 +1,135 @@
+#!/usr/bin/env python3
+
+import cProfile
+import functools
+import json
+import time
+
+
+class Profiler:
+    """
+    The Profiler class collects per-phase timers, counters and an improvement trace
+    for a solver run.
+
+    It is disabled by default. While disabled, a timed function only checks the
+    enabled flag before calling the original function, and count() and trace()
+    return at once, so they are only called once per pass or per improvement,
+    never once per evaluated move.
+
+    Attributes:
+        enabled (bool): True while statistics are being collected.
+        phases (dict[str, list]): [number of calls, total seconds] of each phase.
+        counters (dict[str, int]): Counters such as moves examined and applied.
+        traces (list[tuple]): (seconds since enable(), label, tour length) of each improvement.
+    """
+
+    def __init__(self):
+        self.enabled = False
+        self.reset()
+
+    def reset(self):
+        self.phases = {}
+        self.counters = {}
+        self.traces = []
+        self.start_time = time.perf_counter()
+
+    def enable(self):
+        self.reset()
+        self.enabled = True
+
+    def disable(self):
+        self.enabled = False
+
+    def timed(self, phase):
+        """
+        Decorator that adds the calls and the time of the function to the phase.
+        Nested calls of the same phase are counted once, by the outermost call.
+        """
+        def decorator(func):
+            depth = 0
+
+            @functools.wraps(func)
+            def wrapper(*args, **kwargs):
+                nonlocal depth
+                if not self.enabled or depth:
+                    return func(*args, **kwargs)
+                depth += 1
+                start = time.perf_counter()
+                try:
+                    return func(*args, **kwargs)
+                finally:
+                    depth -= 1
+                    self.add_time(phase, time.perf_counter() - start)
+            return wrapper
+        return decorator
+
+    def add_time(self, phase, seconds):
+        entry = self.phases.setdefault(phase, [0, 0.0])
+        entry[0] += 1
+        entry[1] += seconds
+
+    def count(self, name, n=1):
+        if self.enabled:
+            self.counters[name] = self.counters.get(name, 0) + n
+
+    def trace(self, label, length):
+        if self.enabled:
+            self.traces.append((time.perf_counter() - self.start_time, label, float(length)))
+
+    def to_dict(self):
+        return {
+            'phases': {phase: {'calls': calls, 'seconds': seconds}
+                       for phase, (calls, seconds) in self.phases.items()},
+            'counters': dict(self.counters),
+            'trace': [{'time': t, 'label': label, 'length': length} for t, label, length in self.traces],
+        }
+
+    def dump(self, filename):
+        """
+        Writes the statistics as JSON.
+        """
+        with open(filename, 'w') as f:
+            json.dump(self.to_dict(), f, indent=2)
+
+    def summary(self):
+        """
+        Returns the phases and the counters as a human readable table.
+        """
+        lines = [f'{"phase":<24} {"calls":>10} {"seconds":>10}']
+        for phase, (calls, seconds) in sorted(self.phases.items(), key=lambda item: -item[1][1]):
+            lines.append(f'{phase:<24} {calls:>10} {seconds:>10.3f}')
+        for name, value in sorted(self.counters.items()):
+            lines.append(f'{name:<24} {value:>10}')
+        return '\n'.join(lines)
+
+
+# すべてのソルバーで共有するProfiler
+profiler = Profiler()
+
+
+# ソルバーのargparseに統計を出すオプションを加える
+def add_arguments(parser):
+    parser.add_argument('--stats', default=None,
+                        help='write phase timers, move counters and the improvement trace as JSON')
+    parser.add_argument('--cprofile', default=None,
+                        help='run under cProfile and write the stats (readable with pstats or snakeviz)')
+
+
+# --statsと--cprofileに合わせてfunc(*args)を実行し、その返り値を返す
+# --statsがあればprofilerを有効にして、終わったら表と同じ内容をJSONに書き出す
+# |options|: add_argumentsを加えたparserのparse_args()の返り値
+def run(options, func, *args):
+    if options.stats:
+        profiler.enable()
+    cprofile = cProfile.Profile() if options.cprofile else None
+    try:
+        if cprofile is not None:
+            return cprofile.runcall(func, *args)
+        return func(*args)
+    finally:
+        if cprofile is not None:
+            cprofile.dump_stats(options.cprofile)
+        if options.stats:
+            profiler.disable()
+            profiler.dump(options.stats)
+            print(profiler.summary())
@@ -1,9 +1,17 @@
 #!/usr/bin/env python3
 
-import sys
-import math
+import argparse
+from collections import deque
 
-from common import print_tour, read_input, write_tour
+from common import add_matrix_arguments, build_distance_matrix, print_tour, read_input, write_tour
+from construction import CONSTRUCTIONS, START_DEPENDENT, construct_tour
+import lower_bound
+from lower_bound import target_bound
+from multistart import best_of_multistart, multistart
+from neighbors import k_nearest_neighbors
+import profiling
+from profiling import profiler
+from two_level_tour import TwoLevelTour
 
 def get_total_distance(tour, dist):
   total = 0
@@ -11,8 +19,31 @@ def get_total_distance(tour, dist):
     total += dist[tour[i]][tour[i+1]]
   return total
 
-def opt2(tour: list[int], dist: list[list[float]]) -> bool:
+# 改善とみなす最小の差(浮動小数点の誤差で同じ入れ替えを繰り返さないようにする)
+EPS = 1e-9
+# この都市数以上で近傍リストがあるときは、opt2をTwoLevelTourの上で行う
+TWO_LEVEL_THRESHOLD = 50000
+
+# 都市番号 -> tourの中の位置 のリストを返す(最後に戻ってくる都市は除く)
+def tour_positions(tour: list[int]) -> list[int]:
+  pos = [0] * (len(tour) - 1)
+  for i in range(len(tour) - 1):
+    pos[tour[i]] = i
+  return pos
+
+# tour[i + 1: j + 1]をその場で反転し、反転した範囲のposを更新する
+def reverse_segment(tour: list[int], pos: list[int], i: int, j: int) -> None:
+  tour[i + 1: j + 1] = tour[j: i: -1]
+  for k in range(i + 1, j + 1):
+    pos[tour[k]] = k
+
+@profiler.timed('opt2')
+def opt2(tour: list[int], dist: list[list[float]], neighbors: list[list[int]] = None) -> bool:
+  if neighbors is not None:
+    return opt2_neighbors(tour, dist, neighbors)
+
   improved = False
+  applied = 0
   for i in range(len(tour) - 2):
     for j in range(i + 2, len(tour) - 1):
       a, b = tour[i], tour[i + 1]
@@ -23,71 +54,277 @@ def opt2(tour: list[int], dist: list[list[float]]) -> bool:
         reversed_tour = list(reversed(tour[i + 1: j + 1]))
         tour = tour[: i + 1] + reversed_tour + tour[j + 1:]
         improved = True
+        applied += 1
 
+  # 二重ループの手の数は都市リストの長さだけで決まるので、ループの中では数えずに式で足す
+  n = len(tour)
+  profiler.count('opt2.evaluated', max(n - 3, 0) * max(n - 2, 0) // 2)
+  profiler.count('opt2.applied', applied)
   return improved, tour
 
-def greedy_and_opt2(cities, dist, start_city):
-    N = len(cities)
+# 近傍リストを使ったopt2、辺a->bに対してaの近傍cだけを相手として調べるのでO(N・k)で1周できる
+# 新しい辺(a, c)は元の辺(a, b)より短くないと改善しないので、近い順に見てそれ以上遠くなったら打ち切る
+# |neighbors|: 都市ごとの近い順の都市番号のリスト
+def opt2_neighbors(tour: list[int], dist: list[list[float]], neighbors: list[list[int]]) -> bool:
+  improved = False
+  applied = evaluated = 0
+  N = len(tour) - 1
+  pos = tour_positions(tour)
 
-    # greedyで訪問したことない年の中で一番近い都市を次に持ってくる
-    # current_cityに最初の出発都市を追加し、まだ訪問していない都市を全てに設定する
-    current_city = start_city
-    unvisited_cities = {i for i in range(N) if i != start_city}
-    tour = [current_city]
+  for a in range(N):
+    # a->b と c->d を a->c と b->d に繋ぎ変える
+    i = pos[a]
+    b = tour[i + 1]
+    for c in neighbors[a]:
+      evaluated += 1
+      g1 = dist[a][b] - dist[a][c]
+      if g1 <= EPS:
+        break
+      j = pos[c]
+      d = tour[j + 1]
+      if c == b or d == a:
+        continue
+      if g1 + dist[c][d] - dist[b][d] > EPS:
+        reverse_segment(tour, pos, min(i, j), max(i, j))
+        improved = True
+        applied += 1
+        break
+
+    # p->a と q->c を p->q と a->c に繋ぎ変える
+    i = (pos[a] - 1) % N
+    p = tour[i]
+    for c in neighbors[a]:
+      evaluated += 1
+      g1 = dist[p][a] - dist[a][c]
+      if g1 <= EPS:
+        break
+      j = (pos[c] - 1) % N
+      q = tour[j]
+      if c == p or q == a:
+        continue
+      if g1 + dist[q][c] - dist[p][q] > EPS:
+        reverse_segment(tour, pos, min(i, j), max(i, j))
+        improved = True
+        applied += 1
+        break
+
+  profiler.count('opt2.evaluated', evaluated)
+  profiler.count('opt2.applied', applied)
+  return improved, tour
+
+# 巡回路order(最後に戻ってくる都市は含まない)の位置iから位置jまでを、その場で反転する
+# 反転する区間の外側を反転しても同じ巡回路になるので、短い方を反転する
+def reverse_cyclic(order: list[int], pos: list[int], i: int, j: int) -> None:
+  N = len(order)
+  length = (j - i) % N + 1
+  if length * 2 > N:
+    i, j = (j + 1) % N, (i - 1) % N
+    length = N - length
+
+  for _ in range(length // 2):
+    ci, cj = order[i], order[j]
+    order[i], order[j] = cj, ci
+    pos[cj], pos[ci] = i, j
+    i = i + 1 if i + 1 < N else 0
+    j = j - 1 if j > 0 else N - 1
+
+# don't look bitsを使ったopt2、一度調べて改善できなかった都市は、周りの辺が変わるまで調べない
+# 改善できたら変わった辺の端の都市だけをキューに戻すので、毎回全部の都市を調べ直さなくてよい
+# 結び目がなくなるまで繰り返し、opt2と同じく(改善したかどうか, 都市リスト)を返す
+# |neighbors|: 都市ごとの近い順の都市番号のリスト、Noneのときはすべての都市を相手に調べる
+@profiler.timed('opt2')
+def opt2_dont_look_bits(tour: list[int], dist: list[list[float]], neighbors: list[list[int]] = None) -> tuple[bool, list[int]]:
+  improved = False
+  start_city = tour[0]
+  order = tour[:-1]
+  N = len(order)
+  pos = [0] * N
+  for i in range(N):
+    pos[order[i]] = i
+
+  # キューに入っている都市はdon't look bitが立っていない都市
+  queue = deque(order)
+  in_queue = [True] * N
+  changed = False
+  evaluated = applied = 0
 
-    # まだ訪問されていない都市を訪問する
-    while unvisited_cities:
-        next_city = min(unvisited_cities,
-                        key=lambda city: dist[current_city][city])
-        unvisited_cities.remove(next_city)
+  while queue:
+    a = queue.popleft()
+    in_queue[a] = False
 
-        # tourにnext_cityを追加する
-        tour.append(next_city)
-        current_city = next_city
+    # 反転した区間の中の都市は前後の向きが変わるので、キューが空になったら念のため全体を一周確かめる
+    if not queue and changed:
+      queue.extend(order)
+      in_queue = [True] * N
+      in_queue[a] = False
+      changed = False
+    candidates = neighbors[a] if neighbors is not None else range(N)
+
+    for succ in (True, False):
+      i = pos[a]
+      b = order[(i + 1) % N] if succ else order[i - 1]
+      d_ab = dist[a][b]
+      move = None
+      for c in candidates:
+        evaluated += 1
+        g1 = d_ab - dist[a][c]
+        if g1 <= EPS:
+          if neighbors is not None:
+            break
+          continue
+        j = pos[c]
+        d = order[(j + 1) % N] if succ else order[j - 1]
+        if c == a or c == b or d == a:
+          continue
+        if g1 + dist[c][d] - dist[b][d] > EPS:
+          move = (c, d)
+          break
+      if move is None:
+        continue
+
+      # a->b と c->d を a->c と b->d に繋ぎ変える(predのときは向きが逆)
+      c, d = move
+      if succ:
+        reverse_cyclic(order, pos, pos[b], pos[c])
+      else:
+        reverse_cyclic(order, pos, pos[c], pos[b])
+      improved = changed = True
+      applied += 1
+      for city in (a, b, c, d):
+        if not in_queue[city]:
+          queue.append(city)
+          in_queue[city] = True
+      break
+
+  profiler.count('opt2.evaluated', evaluated)
+  profiler.count('opt2.applied', applied)
+
+  # 出発都市から始まる都市リストに戻す
+  k = pos[start_city]
+  return improved, order[k:] + order[:k] + [start_city]
+
+# opt2_dont_look_bitsと同じことをTwoLevelTourの上で行う
+# 反転がO(sqrt(N))なので、10万都市以上でも一回の改善が都市数に比例しない
+# |tour|: TwoLevelTour その場で書き換える
+# |neighbors|: 都市ごとの近い順の都市番号のリスト
+# 改善したかどうかを返す
+@profiler.timed('opt2')
+def opt2_two_level(tour: TwoLevelTour, dist: list[list[float]], neighbors: list[list[int]]) -> bool:
+  improved = False
+  N = len(tour)
+  queue = deque(range(N))
+  in_queue = [True] * N
+  changed = False
+  evaluated = applied = 0
+
+  while queue:
+    a = queue.popleft()
+    in_queue[a] = False
+
+    # 反転した区間の中の都市は前後の向きが変わるので、キューが空になったら念のため全体を一周確かめる
+    if not queue and changed:
+      queue.extend(range(N))
+      in_queue = [True] * N
+      in_queue[a] = False
+      changed = False
+
+    for succ in (True, False):
+      b = tour.next(a) if succ else tour.prev(a)
+      d_ab = dist[a][b]
+      move = None
+      for c in neighbors[a]:
+        evaluated += 1
+        g1 = d_ab - dist[a][c]
+        if g1 <= EPS:
+          break
+        d = tour.next(c) if succ else tour.prev(c)
+        if c == b or d == a:
+          continue
+        if g1 + dist[c][d] - dist[b][d] > EPS:
+          move = (c, d)
+          break
+      if move is None:
+        continue
+
+      # a->b ... c->d を a->c ... b->d にする(predのときは d->c ... b->a を d->b ... c->a にする)
+      c, d = move
+      if succ:
+        tour.reverse(b, c)
+      else:
+        tour.reverse(c, b)
+      improved = changed = True
+      applied += 1
+      for city in (a, b, c, d):
+        if not in_queue[city]:
+          queue.append(city)
+          in_queue[city] = True
+      break
+
+  profiler.count('opt2.evaluated', evaluated)
+  profiler.count('opt2.applied', applied)
+  return improved
+
+def greedy_and_opt2(cities, dist, start_city, neighbors=None, construction='greedy'):
+    # greedyで訪問したことない年の中で一番近い都市を次に持ってくる
+    # 一番近い都市はグリッドで探すので、まだ訪問していない都市を全部調べなくてよい
+    # constructionが'hilbert'か'morton'なら、代わりに空間充填曲線に沿って並べる
+    tour = construct_tour(cities, start_city, construction)
 
     # 最初のcityを追加
     tour.append(start_city)
 
     # すべての結び目を解く
-    improved = True
-    while improved:
-      improved, tour = opt2(tour, dist)
+    # 都市が多いときはリストの反転が重いので、TwoLevelTourの上で解く
+    if neighbors is not None and len(cities) >= TWO_LEVEL_THRESHOLD:
+      two_level_tour = TwoLevelTour(tour)
+      opt2_two_level(two_level_tour, dist, neighbors)
+      return two_level_tour.tour(start_city)
+    improved, tour = opt2_dont_look_bits(tour, dist, neighbors)
 
     return tour
 
-def distance(city1, city2):
-    return math.sqrt((city1[0] - city2[0]) ** 2 + (city1[1] - city2[1]) ** 2)
-
-def solve(cities):
+# |num_neighbors|: 指定するとopt2で都市ごとに近いnum_neighbors個の都市だけを調べる
+# |workers|: 出発都市ごとの計算を並列に行うプロセスの数、Noneならすべてのコアを使う
+# |construction|: 最初の都市リストの作り方、construction.CONSTRUCTIONSの名前
+# |target_gap|: 指定するとHeld-Karp下界を求め、一番短い都市リストが下界のtarget_gap以内に入ったら残りの出発都市を試さない
+# |matrix|: 距離行列の持ち方、common.MATRIX_STORAGESのどれか
+def solve(cities, num_neighbors=None, workers=1, construction='greedy', target_gap=None, matrix='list'):
     N = len(cities)
 
     # すべての都市同士の距離を測る
-    dist = [[0] * N for i in range(N)]
-    for i in range(N):
-        for j in range(i, N):
-            dist[i][j] = dist[j][i] = distance(cities[i], cities[j])
-
-    # start_cityを変えてベストスコアを出してみる
-    # best_tourとshortest_distanceに0からスタートした場合の値を入れる
-    tour_start_from_0 = greedy_and_opt2(cities, dist, 0)
-    shortest_distance = get_total_distance(tour_start_from_0, dist)
-    best_tour = tour_start_from_0.copy()
-
-    # start_cityを1からN-1まで変え、一番良いものをとってくる
-    for i in range(1, N):
-      print(i)
-      start_city = i
-      tour = greedy_and_opt2(cities, dist, start_city)
-      total_dist = get_total_distance(tour, dist)
-      if total_dist < shortest_distance:
-        shortest_distance = total_dist
-        best_tour = tour.copy()
-
-    print(get_total_distance(best_tour, dist))
+    dist = build_distance_matrix(cities, matrix)
+
+    # 近傍リストは最初に一度だけ作る
+    neighbors = None
+    if num_neighbors:
+        neighbors = k_nearest_neighbors(cities, num_neighbors).tolist()
+
+    # start_cityを0からN-1まで変え、一番良いものをとってくる
+    # 空間充填曲線の都市リストは出発都市によらず同じなので、0からだけ始める
+    # workersが2以上のときはプロセスを分けて並列に実行し、終わったものから結果を受け取る
+    start_cities = range(N) if construction in START_DEPENDENT else [0]
+    bound = target_bound(cities, target_gap)
+    results = multistart(greedy_and_opt2, cities, dist, start_cities, workers, (neighbors, construction))
+    best_tour, shortest_distance = best_of_multistart(results, bound=bound, target_gap=target_gap)
+
+    print(shortest_distance)
     return best_tour
 
 if __name__ == '__main__':
-    assert len(sys.argv) > 2
-    tour = solve(read_input(sys.argv[1]))
+    parser = argparse.ArgumentParser()
+    parser.add_argument('input_file')
+    parser.add_argument('output_file')
+    parser.add_argument('--neighbors', type=int, default=None,
+                        help='only try 2-opt moves between each city and its k nearest cities')
+    parser.add_argument('--workers', type=int, default=1,
+                        help='number of processes for the start cities (0 uses every core)')
+    parser.add_argument('--construction', choices=CONSTRUCTIONS, default='greedy',
+                        help='how to build the first tour (hilbert and morton only start from city 0)')
+    add_matrix_arguments(parser)
+    lower_bound.add_arguments(parser)
+    profiling.add_arguments(parser)
+    args = parser.parse_args()
+    tour = profiling.run(args, solve, read_input(args.input_file), args.neighbors, args.workers or None,
+                         args.construction, args.target_gap, args.matrix)
     # print_tour(tour)
-    # write_tour(tour, sys.argv[2])
+    # write_tour(tour, args.output_file)
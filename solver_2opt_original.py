@@ -1,9 +1,10 @@
 #!/usr/bin/env python3
 
-import sys
-import math
+import argparse
+from itertools import combinations
 
-from common import print_tour, read_input, write_tour
+from common import build_distance_matrix, print_tour, read_input, write_tour
+from neighbors import cell_size_for
 
 class City:
     """
@@ -14,6 +15,8 @@ class City:
         y (int): The y-coordinate of the city's location.
         name (string): The name of the city
     """
+    __slots__ = ('x', 'y', 'name')
+
     def __init__(self, city, name):
         self.x = city[0]
         self.y = city[1]
@@ -61,6 +64,101 @@ class Intersection:
         t4 = self.is_above_line(self.p3, self.p4, self.p2)
         return t1 * t2 < 0.0 and t3 * t4 < 0.0
 
+def segments_intersect(p1, p2, p3, p4):
+    """
+    Same test as Intersection.has_intersection() on (x, y) tuples, without creating
+    City and Intersection objects for every pair of segments.
+    """
+    (x1, y1), (x2, y2), (x3, y3), (x4, y4) = p1, p2, p3, p4
+    t1 = (x2 - x1) * (y3 - y1) - (y2 - y1) * (x3 - x1)
+    t2 = (x2 - x1) * (y4 - y1) - (y2 - y1) * (x4 - x1)
+    t3 = (x4 - x3) * (y1 - y3) - (y4 - y3) * (x1 - x3)
+    t4 = (x4 - x3) * (y2 - y3) - (y4 - y3) * (x2 - x3)
+    return t1 * t2 < 0.0 and t3 * t4 < 0.0
+
+class SegmentGrid:
+    """
+    The SegmentGrid class buckets the segments of a path into a uniform grid, so that
+    a segment is only tested against the segments that share a cell with it.
+
+    Each segment is put into every cell its bounding box covers. Two segments that
+    cross share the cell of the crossing point, so no crossing is missed, and finding
+    all crossings costs about O(N + K) for N segments and K crossings instead of O(N^2).
+
+    Attributes:
+        cities (list[(float, float)]): Coordinates of the cities.
+        cell_size (float): Length of a side of a cell.
+        cells (dict): Maps (cx, cy) to the set of segments in the cell.
+        segments (set): Segments in the grid, as (smaller city, larger city).
+    """
+    def __init__(self, cities):
+        xs = [x for x, y in cities]
+        ys = [y for x, y in cities]
+        self.cities = cities
+        self.min_x = min(xs, default=0.0)
+        self.min_y = min(ys, default=0.0)
+        self.cell_size = cell_size_for(max(xs, default=0.0) - self.min_x, max(ys, default=0.0) - self.min_y,
+                                       len(cities), 2.0)
+        self.cells = {}
+        self.segments = set()
+
+    def cells_of(self, a, b):
+        """
+        Returns the cells covered by the bounding box of the segment a-b.
+        """
+        (xa, ya), (xb, yb) = self.cities[a], self.cities[b]
+        x0 = int((min(xa, xb) - self.min_x) / self.cell_size)
+        x1 = int((max(xa, xb) - self.min_x) / self.cell_size)
+        y0 = int((min(ya, yb) - self.min_y) / self.cell_size)
+        y1 = int((max(ya, yb) - self.min_y) / self.cell_size)
+        return [(cx, cy) for cx in range(x0, x1 + 1) for cy in range(y0, y1 + 1)]
+
+    def add(self, a, b):
+        segment = (min(a, b), max(a, b))
+        self.segments.add(segment)
+        for cell in self.cells_of(a, b):
+            self.cells.setdefault(cell, set()).add(segment)
+
+    def remove(self, a, b):
+        segment = (min(a, b), max(a, b))
+        self.segments.discard(segment)
+        for cell in self.cells_of(a, b):
+            self.cells[cell].discard(segment)
+
+    def crosses(self, segment1, segment2):
+        """
+        Returns True if the two segments cross. Segments that share a city never cross.
+        """
+        a, b = segment1
+        c, d = segment2
+        if a == c or a == d or b == c or b == d:
+            return False
+        cities = self.cities
+        return segments_intersect(cities[a], cities[b], cities[c], cities[d])
+
+    def crossing(self, a, b):
+        """
+        Returns the segments in the grid that cross the segment a-b.
+        """
+        segment = (min(a, b), max(a, b))
+        found = set()
+        for cell in self.cells_of(a, b):
+            for other in self.cells.get(cell, ()):
+                if other not in found and self.crosses(segment, other):
+                    found.add(other)
+        return found
+
+    def all_crossings(self):
+        """
+        Returns every pair of crossing segments in the grid, each pair once.
+        """
+        found = set()
+        for segments in self.cells.values():
+            for segment1, segment2 in combinations(sorted(segments), 2):
+                if (segment1, segment2) not in found and self.crosses(segment1, segment2):
+                    found.add((segment1, segment2))
+        return sorted(found)
+
 class Path:
     """
     The Path class manages a tour (a sequence of city visits) and helps detect and resolve
@@ -70,71 +168,98 @@ class Path:
         tour (list[int]): List of city indices representing the visit order.
         cities (list[(float, float)]): List of tuples of x and y of the cities
         num_cities (int): Number of cities in the current tour.
-        order_dict (dict): Maps city name to its position in the tour.
+        order_dict (dict): Maps city name to its position in the tour (the first one for the start city).
         lines (list[tuple[City, City]]): Line representing paths between cities next to each other.
+        grid (SegmentGrid): The same lines, bucketed by position for crossing tests.
+        city_objects (list[City]): One City object per city, shared by all the lines.
+        verbose (bool): Print all the lines after every untie (for debugging).
     """
 
-    def __init__(self, tour, cities):
+    def __init__(self, tour, cities, verbose=False):
         self.num_cities = len(tour)
         self.tour = tour
         self.cities = cities
+        self.verbose = verbose
+        self.city_objects = [City(city, name) for name, city in enumerate(cities)]
         self.order_dict = self.update_order_dict()
         self.lines = self.update_lines()
+        self.grid = SegmentGrid(cities)
+        for i in range(self.num_cities - 1):
+            self.grid.add(self.tour[i], self.tour[i + 1])
 
 
     def add_new_city(self, city):
         """
         Adds a new city to the end of the current tour and updates order of the new city and the nums of city.
         """
-        self.lines.append((City(self.cities[self.tour[-1]], self.tour[-1]), City(self.cities[city], city)))
+        self.lines.append((self.city_objects[self.tour[-1]], self.city_objects[city]))
+        self.grid.add(self.tour[-1], city)
         self.tour.append(city)
-        self.order_dict[city] = len(self.tour) - 1
+        self.order_dict.setdefault(city, len(self.tour) - 1)
         self.num_cities += 1
 
     def untie(self):
         """
         Detects and resolves a single intersection between the last added line and any previous line.
-        Uses Intersection class to check for crossing segments.
+        Only the lines that share a grid cell with the last line are tested, and the
+        earliest crossing line is untied, as when every line was tested in order.
         Return true if it has an intersection, if not returns False
         """
-        for i in range(len(self.lines) - 1):
-            p1 = self.lines[i][0]
-            p2 = self.lines[i][1]
-            p3 = self.lines[-1][0]
-            p4 = self.lines[-1][1]
-            intersection = Intersection(p1, p2, p3, p4)
-
-            # if this combination has an intersection, change the order of tour and update lines and order of the cities.
-            if intersection.has_intersection():
-                self.change_tour(p1, p2, p3, p4)
-                self.lines = self.update_lines()
-                self.order_dict = self.update_order_dict()
-                self.show_lines()
-                return True
-        return False
+        if len(self.lines) < 2:
+            return False
+        p3, p4 = self.lines[-1]
+        crossing = self.grid.crossing(p3.name, p4.name)
+        if not crossing:
+            return False
+
+        # if this combination has an intersection, change the order of tour and update lines and order of the cities.
+        i = min(self.line_index(*segment) for segment in crossing)
+        p1, p2 = self.lines[i]
+        self.change_tour(p1, p2, p3, p4)
+        if self.verbose:
+            self.show_lines()
+        return True
 
     def whole_untie(self):
         """
-        Checks for intersections between all pairs of line segments and resolves the first one found.
+        Finds all the intersections with the grid and resolves them in a batch.
+        After each untie only the two new lines can cross something new (the reversed
+        lines keep their positions), so only they are tested for the next batch.
         Returns True if a change was made, otherwise False.
         """
-
-        # check all the combination of paths and check whether they have intersections.
-        # if so, untie it
-        for i in range(len(self.lines) - 1):
-            for j in range(i + 1, len(self.lines)):
-                p1 = self.lines[i][0]
-                p2 = self.lines[i][1]
-                p3 = self.lines[j][0]
-                p4 = self.lines[j][1]
-                intersection = Intersection(p1, p2, p3, p4)
-                if intersection.has_intersection():
-                    self.change_tour(p1, p2, p3, p4)
-                    self.lines = self.update_lines()
-                    self.order_dict = self.update_order_dict()
+        changed = False
+        crossings = self.grid.all_crossings()
+        while crossings:
+            new_lines = []
+            for segment1, segment2 in crossings:
+                # an earlier untie in this batch may have removed one of the lines
+                if segment1 not in self.grid.segments or segment2 not in self.grid.segments:
+                    continue
+                i, j = sorted((self.line_index(*segment1), self.line_index(*segment2)))
+                p1, p2 = self.lines[i]
+                p3, p4 = self.lines[j]
+                self.change_tour(p1, p2, p3, p4)
+                if self.verbose:
                     self.show_lines()
-                    return True
-        return False
+                new_lines += [(p1.name, p3.name), (p2.name, p4.name)]
+                changed = True
+
+            crossings = set()
+            for a, b in new_lines:
+                segment = (min(a, b), max(a, b))
+                if segment in self.grid.segments:
+                    crossings.update(tuple(sorted((segment, other))) for other in self.grid.crossing(a, b))
+            crossings = sorted(crossings)
+        return changed
+
+    def line_index(self, a, b):
+        """
+        Returns the index in lines of the line between the cities a and b.
+        """
+        i = self.order_dict[a]
+        if i + 1 < self.num_cities and self.tour[i + 1] == b:
+            return i
+        return self.order_dict[b]
 
     def update_order_dict(self):
         """
@@ -143,7 +268,7 @@ class Path:
         """
         order_dict = {}
         for i in range(self.num_cities):
-            order_dict[self.tour[i]] = i
+            order_dict.setdefault(self.tour[i], i)
         return order_dict
 
     def update_lines(self):
@@ -155,9 +280,7 @@ class Path:
         """
         lines = []
         for i in range(self.num_cities - 1):
-            current_city = self.cities[self.tour[i]]
-            next_city = self.cities[self.tour[i+1]]
-            lines.append((City(current_city, self.tour[i]), City(next_city, self.tour[i + 1])))
+            lines.append((self.city_objects[self.tour[i]], self.city_objects[self.tour[i + 1]]))
 
         return lines
 
@@ -179,21 +302,32 @@ class Path:
         """
         Reverses the sub-path between p2 and p3 to solve an intersection.
         This is similar to the 2-opt technique used in TSP solvers.
+        Only the order and the lines of the reversed range are updated, instead of
+        rebuilding order_dict and lines for the whole tour.
 
         Args:
             p1, p2: Endpoints of the first intersecting line segment.
             p3, p4: Endpoints of the second intersecting line segment.
 
         """
-        order1 = self.order_dict[p1.name]
         order2 = self.order_dict[p2.name]
         order3 = self.order_dict[p3.name]
-        order4 = self.order_dict[p4.name]
 
-        for i in range(int((order3 - order2) / 2) + 1):
-            temp = self.tour[order2 + i]
-            self.tour[order2 + i] = self.tour[order3 - i]
-            self.tour[order3 - i] = temp
+        # the lines p1-p2 and p3-p4 become p1-p3 and p2-p4
+        self.grid.remove(p1.name, p2.name)
+        self.grid.remove(p3.name, p4.name)
+        self.grid.add(p1.name, p3.name)
+        self.grid.add(p2.name, p4.name)
+
+        tour = self.tour
+        tour[order2: order3 + 1] = tour[order3: order2 - 1 if order2 else None: -1]
+        for i in range(order2, order3 + 1):
+            self.order_dict[tour[i]] = i
+
+        # the lines from p1 to p4 are the only ones that changed
+        objects = self.city_objects
+        self.lines[order2 - 1: order3 + 1] = [(objects[tour[i]], objects[tour[i + 1]])
+                                              for i in range(order2 - 1, order3 + 1)]
 
     def get_tour(self):
         """
@@ -203,17 +337,11 @@ class Path:
 
 
 
-def distance(city1, city2):
-    return math.sqrt((city1[0] - city2[0]) ** 2 + (city1[1] - city2[1]) ** 2)
-
-def solve(cities):
+def solve(cities, verbose=False):
     N = len(cities)
 
     # すべての都市同士の距離を測る
-    dist = [[0] * N for i in range(N)]
-    for i in range(N):
-        for j in range(i, N):
-            dist[i][j] = dist[j][i] = distance(cities[i], cities[j])
+    dist = build_distance_matrix(cities)
 
     # current_cityに最初の出発都市を追加し、まだ訪問していない都市を全てに設定する
     current_city = 0
@@ -221,7 +349,7 @@ def solve(cities):
     tour = [current_city]
 
     # pathのクラスを用意する
-    path = Path(tour, cities)
+    path = Path(tour, cities, verbose)
 
     # まだ訪問されていない都市を訪問する
     while unvisited_cities:
@@ -251,7 +379,12 @@ def solve(cities):
 
 
 if __name__ == '__main__':
-    assert len(sys.argv) > 2
-    tour = solve(read_input(sys.argv[1]))
+    parser = argparse.ArgumentParser()
+    parser.add_argument('input_file')
+    parser.add_argument('output_file')
+    parser.add_argument('--verbose', action='store_true',
+                        help='print all the lines after every untie')
+    args = parser.parse_args()
+    tour = solve(read_input(args.input_file), args.verbose)
     print_tour(tour)
-    write_tour(tour, sys.argv[2])
+    write_tour(tour, args.output_file)
@@ -1,13 +1,35 @@
 #!/usr/bin/env python3
 
-import sys
+import argparse
 import math
+import os
+import pickle
 import random
+import signal
 import time
 
-from common import print_tour, read_input, write_tour
+import numpy as np
+from concurrent.futures import ProcessPoolExecutor
+
+from common import add_matrix_arguments, build_distance_matrix, read_input, write_tour
+from multistart import SharedDistanceMatrix, attach_distance_matrix
+from construction import CONSTRUCTIONS, construct_tour, nearest_neighbor_tour
+import lower_bound
+from lower_bound import gap, gap_reached, target_bound
+import profiling
+from profiling import profiler
+from solver_2opt import TWO_LEVEL_THRESHOLD
+from two_level_tour import TwoLevelTour
 
 TIMES = 10000
+# デフォルトの予算(秒)
+TIME_LIMIT = 60 * 60
+# チェックポイントを書き出す間隔(秒)
+CHECKPOINT_INTERVAL = 60
+# 島モデルで島同士が一番良い都市リストを交換するまでに、それぞれの島が行うannealingの回数
+EPOCH_BATCHES = 20
+# 島モデルで冷え切った島が、一番良い都市リストからやり直すときの確率p(温度はinitial_temperature * p)
+REHEAT_P = 0.5
 
 # 都市番号のリストが与えられたときにそれらを最初から繋ぎ合わせた時の総合距離を返す
 # |tour|: list[int] 都市番号ののリスト
@@ -18,61 +40,97 @@ def get_total_distance(tour: list[int], dist: list[list[float]]) -> float:
     total += dist[tour[i]][tour[i+1]]
   return total
 
-# 現在の都市番号リストから適当に二つの都市を選んで順番を交換し、そのリストを返す
-# |tour|: list[int] 都市番号ののリスト
-# N: 都市の数
-def swap(tour: list[int], N: int) -> list[int]:
-  i, j = random.sample(range(1, N), 2)
-  start = min(i, j)
-  end = max(i, j)
-
-  reversed_tour = list(reversed(tour[start: end + 1]))
-  if start == 0:
-    tour = reversed_tour + tour[end + 1: -1] + [reversed_tour[0]]
-  else:
-    tour = tour[: start] + reversed_tour + tour[end + 1:]
-  return tour
-
-# 焼きなまし法、swap関数を呼び出したときに元の都市リストの総合距離より小さければ、swapされたリストを返す
-# swapした後総合距離が長くなったらpの確率でswapしたリストを返す、それ以外はswapしてないリストが返される
-# |tour|: list[int] 都市番号ののリスト
+# 焼きなまし法をsteps回行う
+# 毎回ランダムな区間tour[i: j + 1]の反転(2opt)を提案し、変わる4本の辺だけで総合距離の差deltaを計算する
+# deltaが0以下なら必ず、正ならexp(-delta / temperature)の確率で受け入れ(メトロポリス基準)、tourをその場で反転する
+# 総合距離はdeltaを足して更新していくので、毎回tour全体を計算し直さない
+# 都市がTWO_LEVEL_THRESHOLD以上あるときは、リストの反転がO(N)で重いので、annealing_two_levelで行う
+# |tour|: list[int] 都市番号のリスト(最初と最後は同じ都市)、その場で書き換える
 # |dist|: list[list[float]]　都市同士の距離が入った二次元リスト
-# |p|: float swapしたリストの方が距離が長くなった場合にswapリストを返す確率
-# |N|: 都市の数
-def annealing(tour: list[int], dist: list[list[float]], p: float, N: int) -> list[int]:
-  current_tour = tour
-  swapped_tour = swap(tour, N)
-  current_dist = get_total_distance(current_tour, dist)
-  swapped_dist = get_total_distance(swapped_tour, dist)
-
-  # もしswapの結果が必ず良ければswapしたものを返し
-  if current_dist > swapped_dist:
-    return swapped_tour
-
-  # そうでなければpの確率でswapしたものを返す
-  elif random.random() < p:
-    return swapped_tour
-  else:
-    return current_tour
+# |temperature|: float 温度、高いほど長くなる反転を受け入れやすい
+# |length|: float 今のtourの総合距離
+# |steps|: int 提案する回数
+# 返り値はsteps回終わった後のtourの総合距離
+@profiler.timed('annealing')
+def annealing(tour: list[int], dist: list[list[float]], temperature: float, length: float, steps: int = TIMES) -> float:
+  N = len(tour) - 1
+  if N < 3:
+    return length
+  if N >= TWO_LEVEL_THRESHOLD:
+    # 作り直しはO(N)だが、steps回の反転がそれぞれO(sqrt(N))になる
+    two_level_tour = TwoLevelTour(tour)
+    length = annealing_two_level(two_level_tour, dist, temperature, length, steps)
+    tour[:] = two_level_tour.tour(tour[0])
+    return length
+  accepted = 0
+
+  rand = random.random
+  randrange = random.randrange
+  exp = math.exp
+  for _ in range(steps):
+    i = randrange(1, N)
+    j = randrange(1, N)
+    if i == j:
+      continue
+    if i > j:
+      i, j = j, i
+
+    # a->b ... c->d を a->c ... b->d にしたときの差
+    a, b = tour[i - 1], tour[i]
+    c, d = tour[j], tour[j + 1]
+    delta = dist[a][c] + dist[b][d] - dist[a][b] - dist[c][d]
+
+    if delta <= 0 or (temperature > 0 and rand() < exp(-delta / temperature)):
+      tour[i: j + 1] = tour[j: i - 1: -1]
+      length += delta
+      accepted += 1
+
+  profiler.count('annealing.proposals', steps)
+  profiler.count('annealing.accepted', accepted)
+  return length
+
+# annealingと同じ焼きなましをTwoLevelTourの上で行う、反転がO(sqrt(N))なので都市数が多いときに使う
+# ランダムな二つの都市a, cを選び、a->b ... c->d を a->c ... b->d にする反転を提案する
+# |tour|: TwoLevelTour その場で書き換える
+# |dist|: list[list[float]]　都市同士の距離が入った二次元リスト
+# |temperature|: float 温度、高いほど長くなる反転を受け入れやすい
+# |length|: float 今のtourの総合距離
+# |steps|: int 提案する回数
+# 返り値はsteps回終わった後のtourの総合距離
+# annealingから呼ばれるので、時間はannealingの時間に含まれる
+def annealing_two_level(tour: TwoLevelTour, dist: list[list[float]], temperature: float, length: float, steps: int = TIMES) -> float:
+  N = len(tour)
+  if N < 4:
+    return length
+  accepted = 0
+
+  rand = random.random
+  randrange = random.randrange
+  exp = math.exp
+  for _ in range(steps):
+    a = randrange(N)
+    c = randrange(N)
+    b = tour.next(a)
+    d = tour.next(c)
+    if a == c or b == c or d == a:
+      continue
+
+    delta = dist[a][c] + dist[b][d] - dist[a][b] - dist[c][d]
+    if delta <= 0 or (temperature > 0 and rand() < exp(-delta / temperature)):
+      tour.reverse(b, c)
+      length += delta
+      accepted += 1
+
+  profiler.count('annealing.proposals', steps)
+  profiler.count('annealing.accepted', accepted)
+  return length
 
 # 貪欲法で訪問したことない年の中で一番近い都市を次に訪問し、そのリストを返す
-# |dist|: list[list[float]]　都市同士の距離が入った二次元リスト
+# 一番近い都市は距離行列ではなくグリッドで探す
+# |cities|: list[list[float]]: それぞれの都市番号のリストにx座標とy座標を入れたリスト
 # |start_city|: int 最初に訪問する都市番号
-# |N|: 都市の数
-def greedy(dist: list[list[float]], start_city: int, N: int) -> list[int]:
-  current_city = start_city
-  unvisited_cities = {i for i in range(N) if i != 0}
-  tour = [current_city]
-
-  # まだ訪問されていない都市を訪問する
-  while unvisited_cities:
-      next_city = min(unvisited_cities,
-                      key=lambda city: dist[current_city][city])
-      unvisited_cities.remove(next_city)
-
-      # tourにnext_cityを追加する
-      tour.append(next_city)
-      current_city = next_city
+def greedy(cities: list[list[float]], start_city: int) -> list[int]:
+  tour = nearest_neighbor_tour(cities, start_city)
 
   # 最初のcityを追加
   tour.append(start_city)
@@ -87,11 +145,22 @@ def random_tour(N: int) -> list[int]:
   tour.append(tour[0])
   return tour
 
+# 焼きなましを始める都市リストを返す
+# |cities|: list[list[float]]: それぞれの都市番号のリストにx座標とy座標を入れたリスト
+# |initial|: str 'random'ならランダム、それ以外はconstruction.CONSTRUCTIONSの名前の作り方で作る
+def initial_tour(cities: list[list[float]], initial: str) -> list[int]:
+  if initial == 'random':
+    return random_tour(len(cities))
+  tour = construct_tour(cities, 0, initial)
+  tour.append(tour[0])
+  return tour
+
 # opt2のアルゴリズムで受け取った都市リストを最適化し、もし結び目があったらTrueと都市リストを返す
 # なかったらFlaseと都市リストを返す
 # 二組の辺が交差していたら解くアルゴリズム
 # |tour|: list[int] 都市番号ののリスト
 # |dist|: list[list[float]]　都市同士の距離が入った二次元リスト
+@profiler.timed('opt2')
 def opt2(tour: list[int], dist: list[list[float]]) -> tuple[bool, list[int]]:
   improved = False
   for i in range(len(tour) - 2):
@@ -112,6 +181,7 @@ def opt2(tour: list[int], dist: list[list[float]]) -> tuple[bool, list[int]]:
 # a->b->c d->e => a->c d->b->eの方が効率的であるなら入れ替えるアルゴリズム
 # |tour|: list[int] 都市番号ののリスト
 # |dist|: list[list[float]]　都市同士の距離が入った二次元リスト
+@profiler.timed('or_1_opt')
 def or_1_opt(tour: list[int], dist: list[list[float]]) -> tuple[bool, list[int]]:
   improved = False
   for i in range(len(tour) - 3):
@@ -131,6 +201,7 @@ def or_1_opt(tour: list[int], dist: list[list[float]]) -> tuple[bool, list[int]]
 # a->b->c->d e->f => a->d e->b->c->fの方が効率的であるなら入れ替えるアルゴリズム
 # |tour|: list[int] 都市番号ののリスト
 # |dist|: list[list[float]]　都市同士の距離が入った二次元リスト
+@profiler.timed('or_2_opt')
 def or_2_opt(tour: list[int], dist: list[list[float]]) -> tuple[bool, list[int]]:
   improved = False
   for i in range(len(tour) - 4):
@@ -145,98 +216,408 @@ def or_2_opt(tour: list[int], dist: list[list[float]]) -> tuple[bool, list[int]]
 
   return improved, tour
 
+# tourのコピーをopt2とor_1_optとor_2_optで改善できなくなるまで改善して返す
+# |should_stop|: 改善を繰り返す前に呼び、Trueを返したらそこまでの結果を返す
+def polish(tour: list[int], dist: list[list[float]], should_stop=lambda: False) -> list[int]:
+  opt_tour = tour.copy()
+  for opt in (opt2, or_1_opt, or_2_opt):
+    improved = True
+    while improved and not should_stop():
+      improved, opt_tour = opt(opt_tour, dist)
+  return opt_tour
+
+# 書き込みの途中で止められても前の出力が壊れないように、一時ファイルに書いてから置き換える
+# |tour|: list[int] 都市番号のリスト
+# |filename|: str 出力ファイル名
+def write_tour_atomic(tour: list[int], filename: str) -> None:
+  tmp = filename + '.tmp'
+  write_tour(tour, tmp)
+  os.replace(tmp, filename)
+
+# 焼きなましの状態をチェックポイントファイルに書き出す
+# 都市リストはint32の配列にして小さくし、書き込みの途中で止められても前のファイルが残るように置き換える
+# |filename|: str チェックポイントファイル名
+# |state|: dict 今の都市リスト、一番良い都市リスト、ステップカウント、経過時間、乱数の状態など
+def save_checkpoint(filename: str, state: dict) -> None:
+  state = dict(state)
+  for key in ('tour', 'best_tour'):
+    state[key] = np.asarray(state[key], dtype=np.int32)
+  tmp = filename + '.tmp'
+  with open(tmp, 'wb') as f:
+    pickle.dump(state, f, protocol=pickle.HIGHEST_PROTOCOL)
+  os.replace(tmp, filename)
+
+# save_checkpointで書き出した状態を読み込む
+# |filename|: str チェックポイントファイル名
+def load_checkpoint(filename: str) -> dict:
+  with open(filename, 'rb') as f:
+    state = pickle.load(f)
+  for key in ('tour', 'best_tour'):
+    state[key] = state[key].tolist()
+  return state
+
 # 1番良い都市リストを返す関数
+# 時間(time_limit秒)か提案の回数(max_iterations回)の予算を使い切るか、SIGTERMかSIGINTを受け取ったら、
+# それまでで一番良い都市リストを返す。温度のスケジュールは予算に合わせて伸び縮みする
 # |cities|: list[list[float]]: それぞれの都市番号のリストにx座標とy座標を入れたリスト
-def solve(cities: list[list[float]]) -> list[int]:
+# |time_limit|: float 秒、0以下なら時間では止めない
+# |max_iterations|: int 焼きなましの提案の回数の上限、Noneなら回数では止めない
+# |output_file|: str 良い都市リストが見つかるたびに書き出すファイル、Noneなら書き出さない
+# |checkpoint_file|: str checkpoint_interval秒ごとと終わるときに状態を書き出すファイル、Noneなら書き出さない
+# |checkpoint_interval|: float チェックポイントを書き出す間隔(秒)
+# |resume|: bool Trueならcheckpoint_fileから状態を読み込んで続きから始める
+#           予算は前の実行で使った分も含めて数える
+# |initial|: str 最初とシャッフルしたときの都市リストの作り方、'random'かconstruction.CONSTRUCTIONSの名前
+# |target_gap|: float 指定すると最初にHeld-Karp下界を求め、一番良い都市リストが下界のtarget_gap以内に入ったら
+#               予算が残っていても止める
+# |matrix|: str 距離行列の持ち方、common.MATRIX_STORAGESのどれか
+def solve(cities: list[list[float]], time_limit: float = TIME_LIMIT, max_iterations: int = None,
+          output_file: str = None, checkpoint_file: str = None,
+          checkpoint_interval: float = CHECKPOINT_INTERVAL, resume: bool = False,
+          initial: str = 'random', target_gap: float = None, matrix: str = 'list') -> list[int]:
     N = len(cities)
+    if N < 4:
+      return list(range(N)) + [0] if N else []
+    if time_limit <= 0 and max_iterations is None:
+      raise ValueError('time_limit or max_iterations must be given')
+    if resume and checkpoint_file is None:
+      raise ValueError('resume needs checkpoint_file')
 
     # すべての都市同士の距離を測る
-    dist = [[0] * N for i in range(N)]
-    for i in range(N):
-        for j in range(i, N):
-            dist[i][j] = dist[j][i] = distance(cities[i], cities[j])
+    dist = build_distance_matrix(cities, matrix)
+    bound = target_bound(cities, target_gap)
 
     # start_cityを変えてベストスコアを出してみる
     # best_tourとshortest_distanceに0からスタートした場合の値を入れる
-    # tour = greedy(dist, i, N)
-    tour = random_tour(N)
+    # tour = greedy(cities, 0)
+    tour = initial_tour(cities, initial)
+    length = get_total_distance(tour, dist)
+
+    # 最初の温度は、良い巡回路の平均的な辺の長さ(約0.7124 * sqrt(面積 / N))だけ長くなる反転を
+    # 半分の確率で受け入れるくらいにする
+    xs = [x for x, y in cities]
+    ys = [y for x, y in cities]
+    area = (max(xs) - min(xs)) * (max(ys) - min(ys))
+    initial_temperature = 0.7124 * math.sqrt(area / N) / math.log(2)
 
     # opt2では二つのペアの点にもし結び目があれば点をswapして解いてより短い距離になるというアルゴリズムを使うが、
     # 結び目がない場合だと、swapすると逆に長くなってしまう
     # opt2でより長い経路を選ぶ確率をpとすると、100回のうち、最初の方はpが高く、後の方につれpが減っていき、
     # より短い経路を選ぶようになるようにする。
+    # 温度はinitial_temperature * pとし、長くなる反転はexp(-delta / 温度)の確率で受け入れる
+    # tは予算のうち今のシャッフルから使った割合(時間と回数の両方があるときは進んでいる方)
     true_start_time = time.time()
     start_time = time.time()
-    time_limit = 60 * 60  # 60分
+    start_iteration = 0
+
+    # SIGTERMやSIGINTを受け取ったら、今のステップが終わったところで止める
+    stop = False
+    def request_stop(signum, frame):
+      nonlocal stop
+      stop = True
+    previous_handlers = {sig: signal.signal(sig, request_stop) for sig in (signal.SIGTERM, signal.SIGINT)}
+
+    def out_of_time():
+      return stop or (time_limit > 0 and time.time() - true_start_time >= time_limit)
+
+    def out_of_budget():
+      return (out_of_time() or (max_iterations is not None and j * TIMES >= max_iterations)
+              or gap_reached(best_distance, bound, target_gap))
 
     j = 0  # ステップカウント
+    restarts = 0
+    improvements = 0
 
     shortest_distance_after_opt = float('inf')
+    best_distance = float('inf')
     best_tour = tour.copy()
 
-    while True:
-        elapsed = time.time() - start_time
-
-        # ここでbreakさせないので、無限ループになります
-        # if (time.time() - true_start_time) > time_limit:
-        #     break
-
-        # 時間に基づく温度（確率p）更新
-        t = elapsed / time_limit  # 0.0 ~ 1.0 に正規化
+    # 経過時間は保存した時刻からの差で戻すので、別のマシンで再開してもよい
+    if resume:
+      state = load_checkpoint(checkpoint_file)
+      if state['num_cities'] != N:
+        raise ValueError(f"checkpoint has {state['num_cities']} cities, but the input has {N}")
+      tour, best_tour = state['tour'], state['best_tour']
+      length = get_total_distance(tour, dist)
+      best_distance = state['best_distance']
+      shortest_distance_after_opt = state['shortest_distance_after_opt']
+      j, start_iteration = state['j'], state['start_iteration']
+      restarts, improvements = state['restarts'], state['improvements']
+      true_start_time = time.time() - state['elapsed']
+      start_time = time.time() - state['cycle_elapsed']
+      random.setstate(state['random_state'])
+      print(f"resumed at {j * TIMES} iterations, best distance {best_distance}")
+
+    def checkpoint():
+      now = time.time()
+      save_checkpoint(checkpoint_file, {
+        'num_cities': N,
+        'tour': tour,
+        'best_tour': best_tour,
+        'best_distance': best_distance,
+        'shortest_distance_after_opt': shortest_distance_after_opt,
+        'j': j,
+        'start_iteration': start_iteration,
+        'restarts': restarts,
+        'improvements': improvements,
+        'elapsed': now - true_start_time,
+        'cycle_elapsed': now - start_time,
+        'random_state': random.getstate(),
+      })
+    last_checkpoint_time = time.time()
+
+    try:
+      while not out_of_budget():
+        t = 0.0
+        if time_limit > 0:
+          t = (time.time() - start_time) / time_limit
+        if max_iterations is not None:
+          t = max(t, (j - start_iteration) * TIMES / max_iterations)
         p = math.exp(-5 * t)
 
-        # 焼きなましステップ
-        tour = annealing(tour, dist, p, N)
+        # 焼きなましステップをTIMES回まとめて行う
+        length = annealing(tour, dist, initial_temperature * p, length)
+        j += 1
 
-        # 結果
-        total_dist = get_total_distance(tour, dist)
+        # 足し合わせた誤差がたまらないように、総合距離を計算し直す
+        length = get_total_distance(tour, dist)
 
         # 出てきたtourをopt2とor_1_optとor_2_optしてみる
-        opt_tour = tour.copy()
-
-        # opt2
-        improved = True
-        while improved:
-          improved, opt_tour = opt2(opt_tour, dist)
-
-        # or_1_opt
-        improved = True
-        while improved:
-          improved, opt_tour = or_1_opt(opt_tour, dist)
-
-        # or_2_opt
-        improved = True
-        while improved:
-          improved, opt_tour = or_2_opt(opt_tour, dist)
+        # 途中で時間がなくなったら、そこまでの結果を使う
+        opt_tour = polish(tour, dist, out_of_time)
         total_dist_after_opt = get_total_distance(opt_tour, dist)
 
         # もしpが0.1を下回ったらもう一度tourをシャッフルし、pも1からスタートします
         if p < 0.1:
           print("shuffle")
           start_time = time.time()
-          tour = random_tour(N)
+          start_iteration = j
+          restarts += 1
+          tour = initial_tour(cities, initial)
+          length = get_total_distance(tour, dist)
           shortest_distance_after_opt = float('inf')
 
         # もしより良いpathが見つかったら、記録
+        # シャッフルしても今までで一番良い都市リストは残しておく
         if total_dist_after_opt < shortest_distance_after_opt:
           shortest_distance_after_opt = total_dist_after_opt
-          print(j, p, total_dist_after_opt)
+          print(j * TIMES, p, total_dist_after_opt)
+        if total_dist_after_opt < best_distance:
+          best_distance = total_dist_after_opt
           best_tour = opt_tour.copy()
-          write_tour(best_tour, sys.argv[2])
-
-        j += 1
-
-    print(f"\nBest distance after 20 minutes: {get_total_distance(best_tour, dist)}")
+          improvements += 1
+          profiler.trace('annealing', best_distance)
+          if output_file is not None:
+            write_tour_atomic(best_tour, output_file)
+
+        if checkpoint_file is not None and time.time() - last_checkpoint_time >= checkpoint_interval:
+          checkpoint()
+          last_checkpoint_time = time.time()
+
+      # 止められたときも、続きから再開できるように書き出しておく
+      if checkpoint_file is not None:
+        checkpoint()
+    finally:
+      for sig, handler in previous_handlers.items():
+        signal.signal(sig, handler)
+
+    elapsed = time.time() - true_start_time
+    reason = 'signal' if stop else 'target gap' if gap_reached(best_distance, bound, target_gap) else 'budget'
+    print(f"\nStopped by {reason} after {elapsed:.1f} s")
+    print(f"iterations: {j * TIMES} ({j * TIMES / max(elapsed, 1e-9):.0f}/s), "
+          f"restarts: {restarts}, improvements: {improvements}")
+    print(f"Best distance: {get_total_distance(best_tour, dist)}")
+    if bound:
+      print(f"Lower bound: {bound}, gap: {100 * gap(best_distance, bound):.2f}%")
     return best_tour
 
-# 二つの都市間の距離を返す関数
-# |city1| :int 都市番号
-# |city2| :int 都市番号
-def distance(city1: int, city2: int) -> float:
-    return math.sqrt((city1[0] - city2[0]) ** 2 + (city1[1] - city2[1]) ** 2)
+# 島(ワーカープロセス)ごとの状態(initializerで一度だけ設定する)
+_island = {}
+
+
+def _init_island(handle, initial_temperature):
+  # Ctrl-Cは親プロセスだけが受け取って、島は今のエポックを終わらせる
+  signal.signal(signal.SIGINT, signal.SIG_IGN)
+  _island['dist'] = attach_distance_matrix(handle)
+  _island['initial_temperature'] = initial_temperature
+
+# 一つの島でEPOCH_BATCHES回annealingを行い、更新した状態を返す
+# 時間の予算の終わり(deadline)を過ぎたら、残りのannealingと仕上げの局所探索を途中でやめる
+# 島ごとに乱数のシードと温度の倍率scaleが違い、pが0.1を下回ったらランダムな都市リストではなく
+# 島で一番良い都市リスト(ほかの島から移ってきたものも含む)からREHEAT_Pの温度でやり直す
+# |state|: dict 島の状態、tour, length, best_tour, best_length, scale, iterations, restarts,
+#          今の周期の情報(cycle_start, cycle_begin, cycle_offset, cycle_iterations), time_limit, deadline, random_state
+def anneal_epoch(state: dict) -> dict:
+  dist = _island['dist']
+  random.setstate(state['random_state'])
+  tour, length = state['tour'], state['length']
+  deadline = state['deadline']
+  def out_of_time():
+    return deadline is not None and time.time() >= deadline
+
+  for _ in range(EPOCH_BATCHES):
+    if out_of_time():
+      break
+    t = state['cycle_offset']
+    if state['time_limit'] > 0:
+      t += (time.time() - state['cycle_start']) / state['time_limit']
+    if state['cycle_iterations']:
+      t = max(t, state['cycle_offset'] + (state['iterations'] - state['cycle_begin']) / state['cycle_iterations'])
+    p = math.exp(-5 * t)
+    if p < 0.1:
+      tour = state['best_tour'].copy()
+      length = state['best_length']
+      state['cycle_start'] = time.time()
+      state['cycle_begin'] = state['iterations']
+      state['cycle_offset'] = math.log(1 / REHEAT_P) / 5
+      state['restarts'] += 1
+      p = REHEAT_P
+    length = annealing(tour, dist, _island['initial_temperature'] * state['scale'] * p, length)
+    state['iterations'] += TIMES
+
+  length = get_total_distance(tour, dist)
+  opt_tour = polish(tour, dist, out_of_time)
+  opt_length = get_total_distance(opt_tour, dist)
+  if opt_length < state['best_length']:
+    state['best_tour'], state['best_length'] = opt_tour, opt_length
+  state['tour'], state['length'] = tour, length
+  state['random_state'] = random.getstate()
+  return state
+
+# 島モデルの焼きなまし、islands個の島がそれぞれのプロセスでseedと温度の倍率を変えて焼きなましを行い、
+# EPOCH_BATCHES回ごとに、輪になった隣の島の一番良い都市リストが自分の今の都市リストより短ければ、それに乗り換える
+# 予算を使い切るか、SIGTERMかSIGINTを受け取ったら、すべての島で一番良い都市リストを返す
+# |cities|: list[list[float]]: それぞれの都市番号のリストにx座標とy座標を入れたリスト
+# |islands|: int 島(プロセス)の数
+# |time_limit|: float 秒、0以下なら時間では止めない
+# |max_iterations|: int 島ごとの焼きなましの提案の回数の上限、Noneなら回数では止めない
+# |output_file|: str 良い都市リストが見つかるたびに書き出すファイル、Noneなら書き出さない
+# |initial|: str 最初の都市リストの作り方、'random'かconstruction.CONSTRUCTIONSの名前
+# |seed|: int 島iは乱数のシードにseed + iを使う
+# |target_gap|: float 指定すると、すべての島で一番良い都市リストがHeld-Karp下界のtarget_gap以内に入ったら止める
+# |matrix|: str 距離行列の持ち方、common.MATRIX_STORAGESのどれか
+def solve_islands(cities: list[list[float]], islands: int, time_limit: float = TIME_LIMIT,
+                  max_iterations: int = None, output_file: str = None, initial: str = 'random',
+                  seed: int = 1, target_gap: float = None, matrix: str = 'list') -> list[int]:
+  N = len(cities)
+  if N < 4:
+    return list(range(N)) + [0] if N else []
+  if time_limit <= 0 and max_iterations is None:
+    raise ValueError('time_limit or max_iterations must be given')
+
+  dist = build_distance_matrix(cities, matrix)
+  bound = target_bound(cities, target_gap)
+  xs = [x for x, y in cities]
+  ys = [y for x, y in cities]
+  area = (max(xs) - min(xs)) * (max(ys) - min(ys))
+  initial_temperature = 0.7124 * math.sqrt(area / N) / math.log(2)
+
+  # 島ごとの温度の倍率は0.5倍から2倍まで
+  states = []
+  for i in range(islands):
+    random.seed(seed + i)
+    tour = initial_tour(cities, initial)
+    length = get_total_distance(tour, dist)
+    states.append({
+      'tour': tour, 'length': length, 'best_tour': tour.copy(), 'best_length': length,
+      'scale': 2 ** (2 * i / max(islands - 1, 1) - 1),
+      'iterations': 0, 'cycle_begin': 0, 'cycle_iterations': max_iterations,
+      'cycle_start': time.time(), 'cycle_offset': 0.0, 'time_limit': time_limit,
+      'restarts': 0, 'random_state': random.getstate(), 'deadline': None,
+    })
+
+  stop = False
+  def request_stop(signum, frame):
+    nonlocal stop
+    stop = True
+  previous_handlers = {sig: signal.signal(sig, request_stop) for sig in (signal.SIGTERM, signal.SIGINT)}
+
+  start_time = time.time()
+  # 島は一回のannealingごとに時間を確かめるので、予算を超えるのはannealing一回と局所探索の一歩くらいになる
+  for state in states:
+    state['deadline'] = start_time + time_limit if time_limit > 0 else None
+  best_length = float('inf')
+  best_tour = states[0]['tour']
+  epochs = migrations = 0
+  try:
+    with SharedDistanceMatrix(dist) as shared:
+      with ProcessPoolExecutor(max_workers=islands, initializer=_init_island,
+                               initargs=(shared.handle(), initial_temperature)) as pool:
+        while not stop and not gap_reached(best_length, bound, target_gap):
+          if time_limit > 0 and time.time() - start_time >= time_limit:
+            break
+          if max_iterations is not None and states[0]['iterations'] >= max_iterations:
+            break
+          states = list(pool.map(anneal_epoch, states))
+          epochs += 1
+
+          for i, state in enumerate(states):
+            if state['best_length'] < best_length:
+              best_length, best_tour = state['best_length'], state['best_tour']
+              print(epochs * EPOCH_BATCHES * TIMES, i, best_length)
+              profiler.trace('island', best_length)
+              if output_file is not None:
+                write_tour_atomic(best_tour, output_file)
+
+          # 輪になった隣の島から一番良い都市リストを受け取る(自分の今の都市リストより短いときだけ)
+          bests = [(state['best_tour'], state['best_length']) for state in states]
+          for i, state in enumerate(states):
+            migrant, migrant_length = bests[i - 1]
+            if migrant_length < state['length']:
+              state['tour'], state['length'] = migrant.copy(), migrant_length
+              migrations += 1
+            if migrant_length < state['best_length']:
+              state['best_tour'], state['best_length'] = migrant.copy(), migrant_length
+  finally:
+    for sig, handler in previous_handlers.items():
+      signal.signal(sig, handler)
+
+  elapsed = time.time() - start_time
+  iterations = sum(state['iterations'] for state in states)
+  restarts = sum(state['restarts'] for state in states)
+  reason = 'signal' if stop else 'target gap' if gap_reached(best_length, bound, target_gap) else 'budget'
+  print(f"\nStopped by {reason} after {elapsed:.1f} s")
+  print(f"islands: {islands}, epochs: {epochs}, iterations: {iterations} ({iterations / max(elapsed, 1e-9):.0f}/s), "
+        f"restarts: {restarts}, migrations: {migrations}")
+  print(f"Best distance: {get_total_distance(best_tour, dist)}")
+  if bound:
+    print(f"Lower bound: {bound}, gap: {100 * gap(best_length, bound):.2f}%")
+  return best_tour
 
 if __name__ == '__main__':
-    assert len(sys.argv) > 2
-    tour = solve(read_input(sys.argv[1]))
-    print_tour(tour)
-    write_tour(tour, sys.argv[2])
+    parser = argparse.ArgumentParser()
+    parser.add_argument('input_file')
+    parser.add_argument('output_file')
+    parser.add_argument('--time-limit', type=float, default=TIME_LIMIT,
+                        help='seconds to run (0 for no limit, then --iterations is required)')
+    parser.add_argument('--iterations', type=int, default=None,
+                        help='maximum number of annealing proposals')
+    parser.add_argument('--checkpoint', default=None,
+                        help='file to save the search state to (default: OUTPUT_FILE.ckpt)')
+    parser.add_argument('--checkpoint-interval', type=float, default=CHECKPOINT_INTERVAL,
+                        help='seconds between checkpoints')
+    parser.add_argument('--resume', action='store_true',
+                        help='continue from the checkpoint instead of starting over')
+    parser.add_argument('--initial', choices=('random', *CONSTRUCTIONS), default='random',
+                        help='how to build the tour to start (and restart) from')
+    parser.add_argument('--islands', type=int, default=1,
+                        help='number of annealing chains in parallel processes that exchange their best tours '
+                             '(0 uses every core; --resume and --checkpoint need one chain)')
+    add_matrix_arguments(parser)
+    lower_bound.add_arguments(parser)
+    profiling.add_arguments(parser)
+    args = parser.parse_args()
+    checkpoint_file = args.checkpoint or args.output_file + '.ckpt'
+    islands = args.islands or os.cpu_count()
+    # 島モデルはチェックポイントを書き出さず読み込みもしないので、指定されたら黙って無視せずに止める
+    if islands > 1 and (args.resume or args.checkpoint):
+      parser.error('--resume and --checkpoint only work with one chain (--islands 1)')
+    if islands > 1:
+      tour = profiling.run(args, solve_islands, read_input(args.input_file), islands, args.time_limit,
+                           args.iterations, args.output_file, args.initial, 1, args.target_gap,
+                           args.matrix)
+    else:
+      tour = profiling.run(args, solve, read_input(args.input_file), args.time_limit, args.iterations,
+                           args.output_file, checkpoint_file, args.checkpoint_interval, args.resume,
+                           args.initial, args.target_gap, args.matrix)
+    write_tour_atomic(tour, args.output_file)
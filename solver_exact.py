@@ -0,0 +1,156 @@
+#!/usr/bin/env python3
+
+import argparse
+
+import numpy as np
+
+from common import build_distance_matrix, read_input, read_tour, write_tour
+from profiling import profiler
+import profiling
+
+# 動的計画法で厳密に解く都市の数の上限(表の大きさは 2^(N-1) x (N-1))
+MAX_EXACT_CITIES = 20
+# 窓の中を厳密に並べ替えるときの、窓の都市の数(両端を含む)
+WINDOW = 12
+# 窓をずらしながら改善する周回の上限
+MAX_WINDOW_PASSES = 3
+EPS = 1e-9
+
+
+# Held-Karpの動的計画法で、都市0から始まり都市1..m-1を一度ずつ訪れる一番短い順番を求める
+# cost[S, j]は都市0から始まり集合Sの都市をすべて訪れてjで終わる道の長さ(Sとjは都市1..m-1のビットと番号 - 1)で、
+# Sの大きさごとに cost[S, j] = min_k cost[S - {j}, k] + d(k, j) をNumPyでまとめて計算する
+# |d|: m x mの距離の配列
+# |end|: Noneなら都市0に戻る巡回路、それ以外なら都市endで終わる道(両端を固定した道)にする
+# 返り値は(長さ, 都市0から始まる訪問順のリスト)、巡回路のときは最後に戻る都市0を含まない
+def held_karp(d, end=None):
+    m = len(d)
+    if m == 1:
+        return 0.0, [0]
+    if m == 2:
+        return float(d[0, 1] if end is not None else 2 * d[0, 1]), [0, 1]
+
+    k = m - 1
+    full = (1 << k) - 1
+    cost = np.full((1 << k, k), np.inf)
+    parent = np.zeros((1 << k, k), dtype=np.int8)
+    bits = 1 << np.arange(k)
+    cost[bits, np.arange(k)] = d[0, 1:]
+
+    masks = np.arange(1 << k)
+    popcount = np.zeros(1 << k, dtype=np.int64)
+    for j in range(k):
+        popcount += (masks >> j) & 1
+    between = d[1:, 1:]
+    for size in range(2, k + 1):
+        layer = masks[popcount == size]
+        for j in range(k):
+            # 道の終わりに固定した都市は最後の層でだけ終わりになり、最後の層ではその都市でだけ終わる
+            if end is not None and (j == end - 1) != (size == k):
+                continue
+            subsets = layer[(layer >> j) & 1 == 1]
+            previous = cost[subsets ^ (1 << j)] + between[:, j]
+            if end is not None and size < k:
+                previous[:, end - 1] = np.inf
+            best = np.argmin(previous, axis=1)
+            cost[subsets, j] = previous[np.arange(len(subsets)), best]
+            parent[subsets, j] = best
+    profiler.count('exact.states', (1 << k) * k)
+
+    if end is None:
+        totals = cost[full] + d[1:, 0]
+        last = int(np.argmin(totals))
+        length = float(totals[last])
+    else:
+        last = end - 1
+        length = float(cost[full, last])
+
+    # 終わりの都市から親をたどって順番を戻す
+    order = []
+    mask = full
+    while mask:
+        order.append(last + 1)
+        previous = int(parent[mask, last])
+        mask ^= 1 << last
+        last = previous
+    order.append(0)
+    return length, order[::-1]
+
+
+# 都市リストtourのうちwindow都市の窓を一つずつずらしながら、両端を固定して中の順番を厳密に並べ替える
+# opt2やOr-optの後に使うと、それらでは見つからない窓の中の組み替えが見つかる
+# |tour|: 最初と最後が同じ都市の都市リスト
+# |dist|: dist[a][b]で距離が引けるもの
+# |window|: 窓の都市の数(両端を含む)
+# |max_passes|: 一周しても改善がなくなるまで繰り返す周回の上限
+# 返り値は同じ都市から始まる、最初と最後が同じ都市の都市リスト
+@profiler.timed('exact_window')
+def optimize_windows(tour, dist, window=WINDOW, max_passes=MAX_WINDOW_PASSES):
+    start_city = tour[0]
+    order = list(tour[:-1])
+    N = len(order)
+    window = min(window, N, MAX_EXACT_CITIES)
+    if window < 4:
+        return list(tour)
+
+    applied = 0
+    for _ in range(max_passes):
+        improved = False
+        for i in range(N):
+            positions = [(i + p) % N for p in range(window)]
+            cities = [order[p] for p in positions]
+            d = np.array([[dist[a][b] for b in cities] for a in cities], dtype=np.float64)
+            current = sum(d[p, p + 1] for p in range(window - 1))
+            length, best = held_karp(d, end=window - 1)
+            if length < current - EPS:
+                for p, q in zip(positions, best):
+                    order[p] = cities[q]
+                improved = True
+                applied += 1
+        if not improved:
+            break
+    profiler.count('exact_window.applied', applied)
+
+    k = order.index(start_city)
+    return order[k:] + order[:k] + [start_city]
+
+
+# MAX_EXACT_CITIES都市までの入力の最短の巡回路を返す(都市0から始まり都市0で終わる)
+def solve(cities):
+    N = len(cities)
+    if N > MAX_EXACT_CITIES:
+        raise ValueError(f'{N} cities are too many to solve exactly (at most {MAX_EXACT_CITIES})')
+    if N == 0:
+        return []
+    dist = np.asarray(build_distance_matrix(cities))
+    length, order = held_karp(dist)
+    print(length)
+    return order + [0]
+
+
+# 入力の都市リストを窓ごとに厳密に並べ替えて改善した都市リストを返す
+def improve(cities, tour, window=WINDOW):
+    dist = build_distance_matrix(cities)
+    tour = list(tour)
+    if tour and tour[0] != tour[-1]:
+        tour.append(tour[0])
+    return optimize_windows(tour, dist, window)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description=f'Solve up to {MAX_EXACT_CITIES} cities exactly, or improve a tour window by window.')
+    parser.add_argument('input_file')
+    parser.add_argument('output_file')
+    parser.add_argument('--improve', default=None,
+                        help='a tour file to improve by reordering every window of cities exactly')
+    parser.add_argument('--window', type=int, default=WINDOW,
+                        help='number of cities in a window, including the two fixed ends')
+    profiling.add_arguments(parser)
+    args = parser.parse_args()
+    cities = read_input(args.input_file)
+    if args.improve:
+        tour = profiling.run(args, improve, cities, read_tour(args.improve), args.window)
+    else:
+        tour = profiling.run(args, solve, cities)
+    write_tour(tour[:-1], args.output_file)
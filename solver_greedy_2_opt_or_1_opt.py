@@ -1,9 +1,9 @@
 #!/usr/bin/env python3
 
 import sys
-import math
 
-from common import print_tour, read_input, write_tour
+from common import build_distance_matrix, print_tour, read_input, write_tour
+from construction import nearest_neighbor_tour
 
 def get_total_distance(tour, dist):
   total = 0
@@ -41,23 +41,9 @@ def opt2(tour: list[int], dist: list[list[float]]) -> bool:
   return improved, tour
 
 def greedy_and_opt2_or_1_opt(cities, dist, start_city):
-    N = len(cities)
-
     # greedyで訪問したことない年の中で一番近い都市を次に持ってくる
-    # current_cityに最初の出発都市を追加し、まだ訪問していない都市を全てに設定する
-    current_city = start_city
-    unvisited_cities = {i for i in range(N) if i != start_city}
-    tour = [current_city]
-
-    # まだ訪問されていない都市を訪問する
-    while unvisited_cities:
-        next_city = min(unvisited_cities,
-                        key=lambda city: dist[current_city][city])
-        unvisited_cities.remove(next_city)
-
-        # tourにnext_cityを追加する
-        tour.append(next_city)
-        current_city = next_city
+    # 一番近い都市はグリッドで探すので、まだ訪問していない都市を全部調べなくてよい
+    tour = nearest_neighbor_tour(cities, start_city)
 
     # 最初のcityを追加
     tour.append(start_city)
@@ -73,17 +59,11 @@ def greedy_and_opt2_or_1_opt(cities, dist, start_city):
       improved, tour = or_1_opt(tour, dist)
     return tour
 
-def distance(city1, city2):
-    return math.sqrt((city1[0] - city2[0]) ** 2 + (city1[1] - city2[1]) ** 2)
-
 def solve(cities):
     N = len(cities)
 
     # すべての都市同士の距離を測る
-    dist = [[0] * N for i in range(N)]
-    for i in range(N):
-        for j in range(i, N):
-            dist[i][j] = dist[j][i] = distance(cities[i], cities[j])
+    dist = build_distance_matrix(cities)
 
     # start_cityを変えてベストスコアを出してみる
     # best_tourとshortest_distanceに0からスタートした場合の値を入れる
@@ -1,9 +1,18 @@
 #!/usr/bin/env python3
 
-import sys
-import math
+import argparse
 
-from common import print_tour, read_input, write_tour
+from common import add_matrix_arguments, build_distance_matrix, print_tour, read_input, write_tour
+from construction import CONSTRUCTIONS, START_DEPENDENT, construct_tour
+import lower_bound
+from lower_bound import target_bound
+from multistart import best_of_multistart, multistart, tour_length
+from neighbors import k_nearest_neighbors
+import profiling
+from profiling import profiler
+from solver_2opt import EPS, TWO_LEVEL_THRESHOLD, opt2, opt2_two_level, tour_positions
+from solver_exact import optimize_windows
+from two_level_tour import TwoLevelTour
 
 def get_total_distance(tour, dist):
   total = 0
@@ -11,8 +20,13 @@ def get_total_distance(tour, dist):
     total += dist[tour[i]][tour[i+1]]
   return total
 
-def or_1_opt(tour: list[int], dist: list[list[float]]) -> bool:
+@profiler.timed('or_1_opt')
+def or_1_opt(tour: list[int], dist: list[list[float]], neighbors: list[list[int]] = None) -> bool:
+  if neighbors is not None:
+    return or_1_opt_neighbors(tour, dist, neighbors)
+
   improved = False
+  applied = 0
   for i in range(len(tour) - 3):
     for j in range(i + 3, len(tour) - 1):
       a, b, c = tour[i], tour[i + 1], tour[i + 2]
@@ -21,12 +35,22 @@ def or_1_opt(tour: list[int], dist: list[list[float]]) -> bool:
       # もしbがac間ではなくde間にある場合の方が短いとき
       if dist[a][b] + dist[b][c] +  dist[d][e] >  dist[a][c] + dist[d][b] + dist[b][e]:
         improved = True
+        applied += 1
         tour = tour[: i + 1] + tour[i + 2: j + 1] + [b] + tour[j + 1: ]
 
+  # 二重ループの手の数は都市リストの長さだけで決まるので、ループの中では数えずに式で足す
+  n = len(tour)
+  profiler.count('or_1_opt.evaluated', max(n - 4, 0) * max(n - 3, 0) // 2)
+  profiler.count('or_1_opt.applied', applied)
   return improved, tour
 
-def or_2_opt(tour: list[int], dist: list[list[float]]) -> bool:
+@profiler.timed('or_2_opt')
+def or_2_opt(tour: list[int], dist: list[list[float]], neighbors: list[list[int]] = None) -> bool:
+  if neighbors is not None:
+    return or_2_opt_neighbors(tour, dist, neighbors)
+
   improved = False
+  applied = 0
   for i in range(len(tour) - 4):
     for j in range(i + 4, len(tour) - 1):
       a, b, c, d = tour[i], tour[i + 1], tour[i + 2], tour[i + 3]
@@ -35,93 +59,245 @@ def or_2_opt(tour: list[int], dist: list[list[float]]) -> bool:
       # もしbがac間ではなくde間にある場合の方が短いとき
       if dist[a][b] + dist[c][d] + dist[e][f] >  dist[a][d] + dist[e][b] + dist[c][f]:
         improved = True
+        applied += 1
         tour = tour[: i + 1] + tour[i + 3: j + 1] + [b, c] + tour[j + 1: ]
 
+  # 二重ループの手の数は都市リストの長さだけで決まるので、ループの中では数えずに式で足す
+  n = len(tour)
+  profiler.count('or_2_opt.evaluated', max(n - 5, 0) * max(n - 4, 0) // 2)
+  profiler.count('or_2_opt.applied', applied)
+  return improved, tour
+
+# tour[s: t + 1]の区間を取り出して、tour[q]とtour[q + 1]の間にその場で入れ直し、動いた範囲のposを更新する
+# qは区間の外の辺(q < s - 1 または q > t)
+def move_segment(tour: list[int], pos: list[int], s: int, t: int, q: int) -> None:
+  segment = tour[s: t + 1]
+  if q > t:
+    tour[s: q + 1] = tour[t + 1: q + 1] + segment
+    start, end = s, q
+  else:
+    tour[q + 1: t + 1] = segment + tour[q + 1: s]
+    start, end = q + 1, t
+  for k in range(start, end + 1):
+    pos[tour[k]] = k
+
+# 近傍リストを使ったor_1_opt、bを入れる先はbの近傍xの前後の辺だけを調べる
+# |neighbors|: 都市ごとの近い順の都市番号のリスト
+def or_1_opt_neighbors(tour: list[int], dist: list[list[float]], neighbors: list[list[int]]) -> bool:
+  improved = False
+  applied = evaluated = 0
+  N = len(tour) - 1
+  pos = tour_positions(tour)
+
+  for b in range(N):
+    # 出発都市は動かさない
+    i = pos[b]
+    if i == 0:
+      continue
+    a, c = tour[i - 1], tour[i + 1]
+    removed = dist[a][b] + dist[b][c] - dist[a][c]
+
+    for x in neighbors[b]:
+      if dist[x][b] >= removed - EPS:
+        break
+      # x->y の間か、w->x の間にbを入れる
+      moved = False
+      for q in (pos[x], (pos[x] - 1) % N):
+        if i - 1 <= q <= i:
+          continue
+        evaluated += 1
+        d, e = tour[q], tour[q + 1]
+        if removed - (dist[d][b] + dist[b][e] - dist[d][e]) > EPS:
+          move_segment(tour, pos, i, i, q)
+          improved = moved = True
+          applied += 1
+          break
+      if moved:
+        break
+
+  profiler.count('or_1_opt.evaluated', evaluated)
+  profiler.count('or_1_opt.applied', applied)
   return improved, tour
 
-def opt2(tour: list[int], dist: list[list[float]]) -> bool:
+# 近傍リストを使ったor_2_opt、隣同士のb->cを入れる先はbの近傍eの後ろの辺とcの近傍fの前の辺だけを調べる
+# |neighbors|: 都市ごとの近い順の都市番号のリスト
+def or_2_opt_neighbors(tour: list[int], dist: list[list[float]], neighbors: list[list[int]]) -> bool:
   improved = False
-  for i in range(len(tour) - 2):
-    for j in range(i + 2, len(tour) - 1):
-      a, b = tour[i], tour[i + 1]
-      c, d = tour[j], tour[j + 1]
-
-      # 結び目を発見した場合
-      if dist[a][b] + dist[c][d] > dist[a][c] + dist[b][d]:
-        reversed_tour = list(reversed(tour[i + 1: j + 1]))
-        tour = tour[: i + 1] + reversed_tour + tour[j + 1:]
+  applied = evaluated = 0
+  N = len(tour) - 1
+  pos = tour_positions(tour)
+
+  for b in range(N):
+    # 出発都市は動かさない
+    i = pos[b]
+    if i == 0 or i + 1 >= N:
+      continue
+    a, c, d = tour[i - 1], tour[i + 1], tour[i + 2]
+    removed = dist[a][b] + dist[c][d] - dist[a][d]
+
+    # e->b->c->f になるような辺(e, f)の位置qの候補
+    positions = [pos[x] for x in neighbors[b]] + [(pos[x] - 1) % N for x in neighbors[c]]
+    for q in positions:
+      if i - 1 <= q <= i + 1:
+        continue
+      evaluated += 1
+      e, f = tour[q], tour[q + 1]
+      if removed - (dist[e][b] + dist[c][f] - dist[e][f]) > EPS:
+        move_segment(tour, pos, i, i + 1, q)
         improved = True
+        applied += 1
+        break
 
+  profiler.count('or_2_opt.evaluated', evaluated)
+  profiler.count('or_2_opt.applied', applied)
   return improved, tour
 
-def greedy_and_opt2_or_1_opt_or_2_opt(cities, dist, start_city):
-    N = len(cities)
+# TwoLevelTourの上で、segment_length個の連続した都市s1->...->s2を近傍の辺の間に入れ直す
+# segment_lengthが1ならor_1_opt、2ならor_2_optと同じ動きで、入れ直しは3回の反転(それぞれO(sqrt(N)))で行う
+# |tour|: TwoLevelTour その場で書き換える
+# |neighbors|: 都市ごとの近い順の都市番号のリスト
+# |segment_length|: 動かす都市の数
+# 改善したかどうかを返す
+@profiler.timed('or_opt')
+def or_opt_two_level(tour: TwoLevelTour, dist: list[list[float]], neighbors: list[list[int]], segment_length: int) -> bool:
+  improved = False
+  applied = evaluated = 0
+  N = len(tour)
+  if N < segment_length + 3:
+    return improved
 
-    # greedyで訪問したことない年の中で一番近い都市を次に持ってくる
-    # current_cityに最初の出発都市を追加し、まだ訪問していない都市を全てに設定する
-    current_city = start_city
-    unvisited_cities = {i for i in range(N) if i != start_city}
-    tour = [current_city]
+  for s1 in range(N):
+    segment = [s1]
+    for _ in range(segment_length - 1):
+      segment.append(tour.next(segment[-1]))
+    s2 = segment[-1]
+    p, n = tour.prev(s1), tour.next(s2)
+    removed = dist[p][s1] + dist[s2][n] - dist[p][n]
+
+    # c->s1...s2->d になる辺(c, d)の候補、cはs1の近傍かdはs2の近傍
+    # or_1_opt_neighborsと同じく、新しい辺が外す辺の差より長くなったら打ち切る
+    move = None
+    for c in neighbors[s1]:
+      if dist[c][s1] >= removed - EPS:
+        break
+      d = tour.next(c)
+      if c in segment or d in segment or c == p:
+        continue
+      evaluated += 1
+      if removed - (dist[c][s1] + dist[s2][d] - dist[c][d]) > EPS:
+        move = (c, d)
+        break
+    if move is None:
+      for d in neighbors[s2]:
+        if dist[s2][d] >= removed - EPS:
+          break
+        c = tour.prev(d)
+        if c in segment or d in segment or c == p:
+          continue
+        evaluated += 1
+        if removed - (dist[c][s1] + dist[s2][d] - dist[c][d]) > EPS:
+          move = (c, d)
+          break
+    if move is None:
+      continue
 
-    # まだ訪問されていない都市を訪問する
-    while unvisited_cities:
-        next_city = min(unvisited_cities,
-                        key=lambda city: dist[current_city][city])
-        unvisited_cities.remove(next_city)
+    # p [s1 ... s2] n ... c d
+    # => p c ... n [s2 ... s1] d => p n ... c [s2 ... s1] d => p n ... c [s1 ... s2] d
+    c, d = move
+    tour.reverse(s1, c)
+    tour.reverse(c, n)
+    tour.reverse(s2, s1)
+    improved = True
+    applied += 1
+
+  profiler.count(f'or_{segment_length}_opt.evaluated', evaluated)
+  profiler.count(f'or_{segment_length}_opt.applied', applied)
+  return improved
 
-        # tourにnext_cityを追加する
-        tour.append(next_city)
-        current_city = next_city
+def greedy_and_opt2_or_1_opt_or_2_opt(cities, dist, start_city, neighbors=None, construction='greedy'):
+    # greedyで訪問したことない年の中で一番近い都市を次に持ってくる
+    # 一番近い都市はグリッドで探すので、まだ訪問していない都市を全部調べなくてよい
+    # constructionが'hilbert'か'morton'なら、代わりに空間充填曲線に沿って並べる
+    tour = construct_tour(cities, start_city, construction)
 
     # 最初のcityを追加
     tour.append(start_city)
 
+    # 都市が多いときはリストの反転や区間の移動が重いので、TwoLevelTourの上で2opt, or_1_opt, or_2_optを行う
+    if neighbors is not None and len(cities) >= TWO_LEVEL_THRESHOLD:
+      two_level_tour = TwoLevelTour(tour)
+      opt2_two_level(two_level_tour, dist, neighbors)
+      for segment_length in (1, 2):
+        while or_opt_two_level(two_level_tour, dist, neighbors, segment_length):
+          pass
+      return two_level_tour.tour(start_city)
+
     # すべての結び目を解く(2opt)
     improved = True
     while improved:
-      improved, tour = opt2(tour, dist)
+      improved, tour = opt2(tour, dist, neighbors)
 
     # or_1_opt, もしある点が別の二つの点の間にある場合に経路が短くなるならそっちにする
     improved = True
     while improved:
-      improved, tour = or_1_opt(tour, dist)
+      improved, tour = or_1_opt(tour, dist, neighbors)
 
     # or_2_opt, もしある隣同士の二つの点が別の二つの点に間にある場合に経路が短くなったらそっちにする
     improved = True
     while improved:
-      improved, tour = or_2_opt(tour, dist)
+      improved, tour = or_2_opt(tour, dist, neighbors)
     return tour
 
-def distance(city1, city2):
-    return math.sqrt((city1[0] - city2[0]) ** 2 + (city1[1] - city2[1]) ** 2)
-
-def solve(cities):
+# |num_neighbors|: 指定するとopt2, or_1_opt, or_2_optで都市ごとに近いnum_neighbors個の都市だけを調べる
+# |workers|: 出発都市ごとの計算を並列に行うプロセスの数、Noneならすべてのコアを使う
+# |construction|: 最初の都市リストの作り方、construction.CONSTRUCTIONSの名前
+# |target_gap|: 指定するとHeld-Karp下界を求め、一番短い都市リストが下界のtarget_gap以内に入ったら残りの出発都市を試さない
+# |exact_window|: 指定すると、一番短い都市リストをその都市数の窓ごとに動的計画法で厳密に並べ替えて仕上げる
+# |matrix|: 距離行列の持ち方、common.MATRIX_STORAGESのどれか
+def solve(cities, num_neighbors=None, workers=1, construction='greedy', target_gap=None, exact_window=0,
+          matrix='list'):
     N = len(cities)
 
     # すべての都市同士の距離を測る
-    dist = [[0] * N for i in range(N)]
-    for i in range(N):
-        for j in range(i, N):
-            dist[i][j] = dist[j][i] = distance(cities[i], cities[j])
-
-    # start_cityを1からN-1まで変え、一番良いものをとってくる
-    shortest_distance = float('inf')
-    best_tour = [0, 0]
-
-    for i in range(0, N):
-      start_city = i
-      tour = greedy_and_opt2_or_1_opt_or_2_opt(cities, dist, start_city)
-      total_dist = get_total_distance(tour, dist)
-      print(i, total_dist)
-      if total_dist < shortest_distance:
-        shortest_distance = total_dist
-        best_tour = tour.copy()
-
-    print(get_total_distance(best_tour, dist))
+    dist = build_distance_matrix(cities, matrix)
+
+    # 近傍リストは最初に一度だけ作る
+    neighbors = None
+    if num_neighbors:
+        neighbors = k_nearest_neighbors(cities, num_neighbors).tolist()
+
+    # start_cityを0からN-1まで変え、一番良いものをとってくる
+    # 空間充填曲線の都市リストは出発都市によらず同じなので、0からだけ始める
+    # workersが2以上のときはプロセスを分けて並列に実行し、終わったものから結果を受け取る
+    start_cities = range(N) if construction in START_DEPENDENT else [0]
+    bound = target_bound(cities, target_gap)
+    results = multistart(greedy_and_opt2_or_1_opt_or_2_opt, cities, dist, start_cities, workers, (neighbors, construction))
+    best_tour, shortest_distance = best_of_multistart(results, bound=bound, target_gap=target_gap)
+    if exact_window:
+        best_tour = optimize_windows(best_tour, dist, exact_window)
+        shortest_distance = tour_length(best_tour, dist)
+
+    print(shortest_distance)
     return best_tour
 
 if __name__ == '__main__':
-    assert len(sys.argv) > 2
-    tour = solve(read_input(sys.argv[1]))
+    parser = argparse.ArgumentParser()
+    parser.add_argument('input_file')
+    parser.add_argument('output_file')
+    parser.add_argument('--neighbors', type=int, default=None,
+                        help='only try moves between each city and its k nearest cities')
+    parser.add_argument('--workers', type=int, default=1,
+                        help='number of processes for the start cities (0 uses every core)')
+    parser.add_argument('--construction', choices=CONSTRUCTIONS, default='greedy',
+                        help='how to build the first tour (hilbert and morton only start from city 0)')
+    parser.add_argument('--exact-window', type=int, default=0,
+                        help='finish by reordering every window of this many cities exactly (about 10-12)')
+    add_matrix_arguments(parser)
+    lower_bound.add_arguments(parser)
+    profiling.add_arguments(parser)
+    args = parser.parse_args()
+    tour = profiling.run(args, solve, read_input(args.input_file), args.neighbors, args.workers or None,
+                         args.construction, args.target_gap, args.exact_window,
+                         args.matrix)
     #print_tour(tour)
-    #write_tour(tour, sys.argv[2])
+    #write_tour(tour, args.output_file)
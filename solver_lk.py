@@ -0,0 +1,261 @@
+#!/usr/bin/env python3
+
+import argparse
+import random
+import time
+from collections import deque
+
+from common import add_matrix_arguments, build_distance_matrix, read_input, write_tour
+from construction import CONSTRUCTIONS, construct_tour, nearest_neighbor_tour
+import lower_bound
+from lower_bound import gap, gap_reached, target_bound
+from neighbors import k_nearest_neighbors
+import profiling
+from profiling import profiler
+from solver_2opt import EPS, reverse_cyclic
+
+# 一回の改善で繋げる2optの最大の数
+MAX_DEPTH = 50
+# 最初の一手で試すt3の候補の数(二手目からは一番良いものだけを試す)
+BREADTH = 5
+
+
+class LinKernighan:
+    """
+    The LinKernighan class improves a tour with Lin-Kernighan style variable-depth moves.
+
+    Starting from an edge (t1, t2), it repeatedly adds an edge (t2, t3) to one of the
+    nearest neighbors of t2, removes the edge (t3, t4) that keeps the tour closable,
+    and continues from t4. Each step is applied as a 2-opt flip, so a chain of k steps
+    is a sequential k-opt move. The best prefix of the chain is kept and the rest is
+    undone. Cities are examined from a queue of don't-look bits.
+
+    Attributes:
+        order (list[int]): Cities in tour order (the start city is not repeated).
+        pos (list[int]): Position of each city in order.
+        dist (list[list[float]]): Distances between cities, accessed as dist[a][b].
+        neighbors (list[list[int]]): Nearest cities of each city, nearest first.
+    """
+
+    def __init__(self, tour, dist, neighbors):
+        self.order = list(tour)
+        if len(self.order) > 1 and self.order[0] == self.order[-1]:
+            self.order.pop()
+        self.num_cities = len(self.order)
+        self.pos = [0] * self.num_cities
+        for i, city in enumerate(self.order):
+            self.pos[city] = i
+        self.dist = dist
+        self.neighbors = neighbors
+
+    def succ(self, city):
+        i = self.pos[city] + 1
+        return self.order[i if i < self.num_cities else 0]
+
+    def pred(self, city):
+        return self.order[self.pos[city] - 1]
+
+    def length(self):
+        order, dist = self.order, self.dist
+        return sum(dist[order[i - 1]][order[i]] for i in range(self.num_cities))
+
+    def tour(self, start_city=None):
+        """
+        Returns the tour as a list that starts and ends with start_city.
+        """
+        if start_city is None:
+            start_city = self.order[0]
+        k = self.pos[start_city]
+        return self.order[k:] + self.order[:k] + [start_city]
+
+    def move(self, t1, t2, t3, t4):
+        """
+        Removes the edges (t1, t2) and (t3, t4) and adds (t2, t3) and (t4, t1).
+        t4 must be the neighbor of t3 on the same side as t1 is of t2.
+        """
+        if self.succ(t1) == t2:
+            reverse_cyclic(self.order, self.pos, self.pos[t2], self.pos[t4])
+        else:
+            reverse_cyclic(self.order, self.pos, self.pos[t4], self.pos[t2])
+
+    def improve_from(self, t1, t2):
+        """
+        Tries a variable-depth move that starts by removing the edge (t1, t2).
+        Applies the best improving prefix and returns (gain, touched cities).
+        """
+        dist, neighbors = self.dist, self.neighbors
+        first_choices = self.choices(t1, t2, dist[t1][t2], set())[:BREADTH]
+
+        for t3, t4 in first_choices:
+            gain = dist[t1][t2]
+            added = set()
+            flips = []
+            best_gain, best_depth = 0.0, 0
+            current = t2
+            next_step = (t3, t4)
+
+            while next_step is not None and len(flips) < MAX_DEPTH:
+                t3, t4 = next_step
+                self.move(t1, current, t3, t4)
+                flips.append((current, t3, t4))
+                added.add((min(current, t3), max(current, t3)))
+                gain += dist[t3][t4] - dist[current][t3]
+
+                # (t4, t1)を繋いで閉じたときの改善量
+                closed_gain = gain - dist[t4][t1]
+                if closed_gain > best_gain + EPS:
+                    best_gain, best_depth = closed_gain, len(flips)
+
+                current = t4
+                choices = self.choices(t1, current, gain, added)
+                next_step = choices[0] if choices else None
+
+            # 一番良かったところまで残して、それより後は元に戻す
+            for current, t3, t4 in reversed(flips[best_depth:]):
+                self.move(t1, t4, t3, current)
+            if best_gain > EPS:
+                touched = {t1}
+                for current, t3, t4 in flips[:best_depth]:
+                    touched.update((current, t3, t4))
+                return best_gain, touched
+
+        return 0.0, set()
+
+    def choices(self, t1, t2, gain, added):
+        """
+        Returns the (t3, t4) candidates for the next step after removing (t1, t2),
+        best first. t3 is a neighbor of t2 with positive partial gain, and t4 is the
+        neighbor of t3 that keeps the tour closable. Edges added in this chain are
+        never removed again.
+        """
+        dist = self.dist
+        forward = self.succ(t1) == t2
+        scored = []
+        for t3 in self.neighbors[t2]:
+            g1 = gain - dist[t2][t3]
+            if g1 <= EPS:
+                break
+            if t3 == t1:
+                continue
+            t4 = self.pred(t3) if forward else self.succ(t3)
+            if t4 == t2 or (min(t3, t4), max(t3, t4)) in added:
+                continue
+            scored.append((g1 + dist[t3][t4], t3, t4))
+        profiler.count('lk.evaluated', len(scored))
+        scored.sort(reverse=True)
+        return [(t3, t4) for _, t3, t4 in scored]
+
+    @profiler.timed('lk')
+    def optimize(self, queue=None, limit=None):
+        """
+        Applies improving moves until no city in the queue can be improved.
+        The queue starts with every city unless given. Returns the total gain.
+        With a limit, stops after examining that many cities.
+        """
+        if queue is None:
+            queue = list(self.order)
+        queue = deque(queue)
+        in_queue = [False] * self.num_cities
+        for city in queue:
+            in_queue[city] = True
+
+        total_gain = 0.0
+        examined = applied = 0
+        while queue and (limit is None or examined < limit):
+            t1 = queue.popleft()
+            in_queue[t1] = False
+            examined += 1
+            for t2 in (self.succ(t1), self.pred(t1)):
+                gain, touched = self.improve_from(t1, t2)
+                if gain > 0:
+                    total_gain += gain
+                    applied += 1
+                    for city in touched:
+                        if not in_queue[city]:
+                            queue.append(city)
+                            in_queue[city] = True
+                    break
+        profiler.count('lk.examined', examined)
+        profiler.count('lk.applied', applied)
+        return total_gain
+
+    def double_bridge(self, rng):
+        """
+        Applies a random double-bridge kick (a non-sequential 4-opt move that LK
+        cannot undo) and returns the endpoints of the changed edges.
+        """
+        N = self.num_cities
+        i, j, k = sorted(rng.sample(range(1, N), 3))
+        order = self.order
+        touched = {order[i - 1], order[i], order[j - 1], order[j], order[k - 1], order[k]}
+        self.order = order[:i] + order[j:k] + order[i:j] + order[k:]
+        for p in range(i, k):
+            self.pos[self.order[p]] = p
+        return touched
+
+
+# 貪欲法で作った都市リストをLin-Kernighan法で改善した都市リストを返す
+# time_limitを指定すると、その時間までdouble bridgeで崩してからLin-Kernighan法をやり直し、
+# 短くなったときだけ採用する(Chained Lin-Kernighan)
+# |cities|: 都市のx座標とy座標のリスト
+# |num_neighbors|: 都市ごとに調べる近傍の数
+# |time_limit|: 秒、0ならLin-Kernighan法を一回だけ行う
+# |seed|: double bridgeの乱数のシード
+# |construction|: 最初の都市リストの作り方、construction.CONSTRUCTIONSの名前
+# |target_gap|: 指定するとHeld-Karp下界を求めてギャップを表示し、下界のtarget_gap以内に入ったらtime_limitの前でも止める
+# |matrix|: 距離行列の持ち方、common.MATRIX_STORAGESのどれか
+def solve(cities, num_neighbors=8, time_limit=0, seed=1, construction='greedy', target_gap=None, matrix='list'):
+    N = len(cities)
+    if N < 5:
+        return nearest_neighbor_tour(cities, 0) + [0] if N else []
+
+    dist = build_distance_matrix(cities, matrix)
+    neighbors = k_nearest_neighbors(cities, num_neighbors).tolist()
+
+    lk = LinKernighan(construct_tour(cities, 0, construction), dist, neighbors)
+    lk.optimize()
+    length = lk.length()
+    bound = target_bound(cities, target_gap, length)
+    print(0, length, *([f'{100 * gap(length, bound):.2f}%'] if bound else []))
+    profiler.trace('lk', length)
+
+    rng = random.Random(seed)
+    deadline = time.time() + time_limit
+    kicks = 0
+    while time.time() < deadline and not gap_reached(length, bound, target_gap):
+        saved_order = lk.order.copy()
+        touched = lk.double_bridge(rng)
+        lk.optimize(touched)
+        new_length = lk.length()
+        kicks += 1
+        if new_length < length - EPS:
+            length = new_length
+            print(kicks, length, *([f'{100 * gap(length, bound):.2f}%'] if bound else []))
+            profiler.trace('kick', length)
+        else:
+            lk.order = saved_order
+            for i, city in enumerate(saved_order):
+                lk.pos[city] = i
+
+    profiler.count('lk.kicks', kicks)
+    print(length)
+    return lk.tour(0)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('input_file')
+    parser.add_argument('output_file')
+    parser.add_argument('--neighbors', type=int, default=8,
+                        help='number of nearest cities tried for each new edge')
+    parser.add_argument('--time-limit', type=float, default=0,
+                        help='seconds of double-bridge kicks after the first Lin-Kernighan run')
+    parser.add_argument('--construction', choices=CONSTRUCTIONS, default='greedy',
+                        help='how to build the first tour')
+    add_matrix_arguments(parser)
+    lower_bound.add_arguments(parser)
+    profiling.add_arguments(parser)
+    args = parser.parse_args()
+    tour = profiling.run(args, solve, read_input(args.input_file), args.neighbors, args.time_limit, 1,
+                         args.construction, args.target_gap, args.matrix)
+    write_tour(tour[:-1], args.output_file)
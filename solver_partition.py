@@ -0,0 +1,158 @@
+#!/usr/bin/env python3
+
+import argparse
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+
+from common import build_distance_matrix, read_cities, write_tour
+from construction import hilbert_index
+from neighbors import k_nearest_neighbors
+from solver_greedy_2_opt_or_1_opt_or_2_opt import greedy_and_opt2_or_1_opt_or_2_opt
+from solver_lk import LinKernighan
+
+# 一つの領域の都市の数の上限(領域ごとにこの大きさの距離行列を作る)
+REGION_SIZE = 1000
+# 領域の中で使う近傍の数
+NUM_NEIGHBORS = 8
+# 継ぎ目の前後それぞれで最適化し直す都市の数
+SEAM_WINDOW = 100
+# 継ぎ目の最適化で両端を固定するために、両端を結ぶ辺に入れる長さ(この辺は絶対に外されない)
+FIXED_EDGE = -1e12
+
+
+# 平面を長い方の辺の中央値で二つに分けることを繰り返し、region_size都市以下の領域の都市番号の配列のリストを返す
+def bisect(xy, indices, region_size):
+    if len(indices) <= region_size:
+        return [indices]
+    points = xy[indices]
+    axis = int(np.argmax(points.max(axis=0) - points.min(axis=0)))
+    order = indices[np.argsort(points[:, axis], kind='stable')]
+    half = len(order) // 2
+    return bisect(xy, order[:half], region_size) + bisect(xy, order[half:], region_size)
+
+
+# 領域の重心のHilbert曲線に沿った順番に領域を並べ替える、隣の領域が平面でも隣になりやすい
+def order_regions(xy, regions):
+    centers = np.array([xy[region].mean(axis=0) for region in regions])
+    low = centers.min(axis=0)
+    extent = max(float((centers.max(axis=0) - low).max()), 1e-12)
+    scaled = ((centers - low) / extent * ((1 << 16) - 1)).astype(np.int64)
+    index = hilbert_index(scaled[:, 0], scaled[:, 1])
+    return [regions[k] for k in np.argsort(index, kind='stable')]
+
+
+# 一つの領域の巡回路を、今までと同じ貪欲法 + 2opt + Or-optで作る
+# |xy|: 領域の都市の座標、返り値は領域の中での番号の巡回路(最後に戻ってくる都市は含まない)
+def solve_region(xy):
+    n = len(xy)
+    if n < 5:
+        return list(range(n))
+    dist = build_distance_matrix(xy)
+    neighbors = k_nearest_neighbors(xy, NUM_NEIGHBORS).tolist()
+    return greedy_and_opt2_or_1_opt_or_2_opt(xy, dist, 0, neighbors)[:-1]
+
+
+# 領域の巡回路を順番に一本の都市リストに繋ぐ
+# 前の領域の最後の都市pから入る都市eと、巡回路で隣にあってそこから出る都市xを、
+# d(p, e) - d(e, x) + d(x, 次の領域の重心) が一番小さくなるように選び、辺(e, x)を切ってeからxまで回る
+def stitch(xy, cycles):
+    tour = []
+    centers = [xy[cycle].mean(axis=0) for cycle in cycles]
+    for k, cycle in enumerate(cycles):
+        cycle = np.asarray(cycle)
+        points = xy[cycle]
+        p = xy[tour[-1]] if tour else centers[k - 1]
+        next_center = centers[(k + 1) % len(cycles)]
+        to_p = np.hypot(*(points - p).T)
+        to_next = np.hypot(*(points - next_center).T)
+        # succ[i]は巡回路でcycle[i]の次の都市とcycle[i]の距離
+        succ = np.hypot(*(points - np.roll(points, -1, axis=0)).T)
+
+        # 前向き: e = cycle[i], x = cycle[i - 1](eから前向きに回ってxで終わる)
+        forward = to_p - np.roll(succ, 1) + np.roll(to_next, 1)
+        # 後ろ向き: e = cycle[i], x = cycle[i + 1](eから後ろ向きに回ってxで終わる)
+        backward = to_p - succ + np.roll(to_next, -1)
+        i_forward, i_backward = int(np.argmin(forward)), int(np.argmin(backward))
+        if forward[i_forward] <= backward[i_backward]:
+            tour.extend(np.roll(cycle, -i_forward).tolist())
+        else:
+            tour.extend(np.roll(cycle[::-1], i_backward + 1).tolist())
+    return tour
+
+
+# 両端を固定した道をLin-Kernighan法で短くして、同じ両端の道を返す
+# 両端を結ぶ辺の長さをとても小さくした巡回路として最適化すると、その辺は外されないので両端が変わらない
+# |xy|: 道の順番に並んだ都市の座標、返り値は道の中での番号の並び(0から始まりlen(xy) - 1で終わる)
+def improve_path(xy):
+    n = len(xy)
+    if n < 8:
+        return list(range(n))
+    dist = build_distance_matrix(xy)
+    dist[0][n - 1] = dist[n - 1][0] = FIXED_EDGE
+    neighbors = k_nearest_neighbors(xy, NUM_NEIGHBORS).tolist()
+    lk = LinKernighan(range(n), dist, neighbors)
+    lk.optimize()
+
+    # 0から、n - 1ではない方の隣へ進む
+    order = lk.tour(0)[:-1]
+    if order[1] == n - 1:
+        order = [0] + order[1:][::-1]
+    return order
+
+
+def _map(func, items, workers):
+    if workers == 1:
+        return list(map(func, items))
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        return list(pool.map(func, items, chunksize=max(len(items) // (4 * (workers or 8)), 1)))
+
+
+# 平面を領域に分けて、領域ごとの巡回路を並列に作ってから繋ぎ、継ぎ目の前後を最適化し直した都市リストを返す
+# 距離行列は領域と継ぎ目の大きさのものしか作らないので、100万都市でもメモリは都市数に比例する
+# |cities|: 都市のx座標とy座標のリスト(N x 2の配列でもよい)
+# |region_size|: 一つの領域の都市の数の上限
+# |workers|: プロセスの数、1ならこのプロセスで順番に計算し、Noneならすべてのコアを使う
+# 返り値は都市0から始まり都市0で終わる都市リスト
+def solve(cities, region_size=REGION_SIZE, workers=1):
+    xy = np.asarray(cities, dtype=np.float64).reshape(-1, 2)
+    N = len(xy)
+    if N == 0:
+        return []
+
+    regions = order_regions(xy, bisect(xy, np.arange(N), region_size))
+    print(f'{len(regions)} regions')
+    cycles = _map(solve_region, [xy[region] for region in regions], workers)
+    tour = stitch(xy, [region[cycle] for region, cycle in zip(regions, cycles)])
+
+    # 継ぎ目(領域の境目と最後から最初へ戻るところ)の前後window都市ずつを両端を固定して最適化し直す
+    # 領域はwindowの2倍以上の大きさなので、継ぎ目の窓同士は重ならない
+    if len(regions) > 1:
+        window = min(SEAM_WINDOW, min(len(region) for region in regions) // 2)
+        tour = np.array(tour)
+        starts = np.cumsum([0] + [len(region) for region in regions[:-1]])
+        tour = np.roll(tour, window)
+        paths = [tour[start: start + 2 * window] for start in starts]
+        improved = _map(improve_path, [xy[path] for path in paths], workers)
+        for start, path, order in zip(starts, paths, improved):
+            tour[start: start + 2 * window] = path[order]
+        tour = tour.tolist()
+
+    k = tour.index(0)
+    tour = tour[k:] + tour[:k] + [0]
+    diff = xy[tour[1:]] - xy[tour[:-1]]
+    print(np.hypot(diff[:, 0], diff[:, 1]).sum())
+    return tour
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('input_file')
+    parser.add_argument('output_file')
+    parser.add_argument('--region-size', type=int, default=REGION_SIZE,
+                        help='maximum number of cities in a region')
+    parser.add_argument('--workers', type=int, default=1,
+                        help='number of processes for the regions (0 uses every core)')
+    args = parser.parse_args()
+    tour = solve(read_cities(args.input_file), args.region_size, args.workers or None)
+    write_tour(tour[:-1], args.output_file)
@@ -0,0 +1,207 @@
+#!/usr/bin/env python3
+
+import math
+
+
+class _Segment:
+    """
+    A run of consecutive cities of a TwoLevelTour.
+
+    Attributes:
+        cities (list[int]): The cities of the segment, in storage order.
+        rev (bool): True if the tour visits the cities in the reverse of storage order.
+        rank (int): Position of the segment in TwoLevelTour.segments.
+    """
+    __slots__ = ('cities', 'rev', 'rank')
+
+    def __init__(self, cities, rev=False, rank=0):
+        self.cities = cities
+        self.rev = rev
+        self.rank = rank
+
+    def first(self):
+        return self.cities[-1] if self.rev else self.cities[0]
+
+    def last(self):
+        return self.cities[0] if self.rev else self.cities[-1]
+
+
+class TwoLevelTour:
+    """
+    The TwoLevelTour class represents a cyclic tour as a two-level list, so that a
+    segment can be reversed in O(sqrt(N)) instead of the O(N) of a plain list.
+
+    The tour is cut into about sqrt(N) segments. Each segment keeps its cities in a
+    list and a reversal bit, and the segments are kept in tour order in a parent list.
+    Reversing a path splits the segments at its two ends, then reverses the order of
+    the whole segments in between and flips their bits. If the path wraps around the
+    end of the parent list, the rest of the tour is reversed instead and a global bit
+    flips the direction of the whole tour. When splits have made too many segments,
+    the tour is cut again into segments of the original size.
+
+    Attributes:
+        num_cities (int): Number of cities in the tour.
+        rev_all (bool): True if the tour goes through the segments backwards.
+        segments (list[_Segment]): The segments in tour order.
+        seg (list[_Segment]): The segment that contains each city.
+        idx (list[int]): Index of each city in the cities of its segment.
+    """
+
+    def __init__(self, tour, segment_size=None):
+        order = list(tour)
+        if len(order) > 1 and order[0] == order[-1]:
+            order.pop()
+        self.num_cities = len(order)
+        self.segment_size = segment_size or max(int(math.sqrt(self.num_cities)), 8)
+        self.seg = [None] * self.num_cities
+        self.idx = [0] * self.num_cities
+        self.rebuild(order)
+
+    def __len__(self):
+        return self.num_cities
+
+    def rebuild(self, order):
+        """
+        Cuts the tour given as a list into segments of segment_size cities.
+        """
+        self.rev_all = False
+        self.segments = []
+        for start in range(0, len(order), self.segment_size):
+            segment = _Segment(order[start: start + self.segment_size], False, len(self.segments))
+            self.segments.append(segment)
+            self.reindex(segment)
+        self.max_segments = 2 * len(self.segments) + 8
+
+    def reindex(self, segment):
+        seg, idx = self.seg, self.idx
+        for i, city in enumerate(segment.cities):
+            seg[city] = segment
+            idx[city] = i
+
+    def next(self, city):
+        """
+        Returns the city visited after the given city.
+        """
+        return self._prev(city) if self.rev_all else self._next(city)
+
+    def prev(self, city):
+        """
+        Returns the city visited before the given city.
+        """
+        return self._next(city) if self.rev_all else self._prev(city)
+
+    def _next(self, city):
+        segment = self.seg[city]
+        i = self.idx[city]
+        if segment.rev:
+            if i > 0:
+                return segment.cities[i - 1]
+        elif i + 1 < len(segment.cities):
+            return segment.cities[i + 1]
+        rank = segment.rank + 1
+        return self.segments[rank if rank < len(self.segments) else 0].first()
+
+    def _prev(self, city):
+        segment = self.seg[city]
+        i = self.idx[city]
+        if segment.rev:
+            if i + 1 < len(segment.cities):
+                return segment.cities[i + 1]
+        elif i > 0:
+            return segment.cities[i - 1]
+        return self.segments[segment.rank - 1].last()
+
+    def position(self, city):
+        """
+        Returns a key that increases along the segments from the first to the last
+        (backwards along the tour when rev_all is set).
+        """
+        segment = self.seg[city]
+        i = self.idx[city]
+        return segment.rank, len(segment.cities) - 1 - i if segment.rev else i
+
+    def between(self, a, b, c):
+        """
+        Returns True if b is on the path that goes forward from a to c (both included).
+        """
+        if self.rev_all:
+            a, c = c, a
+        pa, pb, pc = self.position(a), self.position(b), self.position(c)
+        if pa <= pc:
+            return pa <= pb <= pc
+        return pb >= pa or pb <= pc
+
+    def split_before(self, city):
+        """
+        Splits the segment of the city so that the city becomes the first city of a segment.
+        """
+        segment = self.seg[city]
+        i = self.idx[city]
+        cities = segment.cities
+        if segment.rev:
+            if i == len(cities) - 1:
+                return
+            # 逆向きのときは、保存順で後ろ側が巡回路で先に来る
+            first, second = cities[i + 1:], cities[: i + 1]
+        else:
+            if i == 0:
+                return
+            first, second = cities[:i], cities[i:]
+
+        segment.cities = first
+        new = _Segment(second, segment.rev, segment.rank + 1)
+        self.segments.insert(new.rank, new)
+        for rank in range(new.rank + 1, len(self.segments)):
+            self.segments[rank].rank = rank
+        self.reindex(segment)
+        self.reindex(new)
+
+    def reverse(self, a, b):
+        """
+        Reverses the path that goes forward from a to b, so that the tour
+        ... p a ... b n ... becomes ... p b ... a n ...
+        """
+        if a == b or self.next(b) == a:
+            # 全体を反転しても同じ巡回路
+            return
+        if self.rev_all:
+            a, b = b, a
+        self.split_before(a)
+        self.split_before(self._next(b))
+
+        # aからbまではsegmentsの中で連続しているので、その順番を逆にして向きを反転する
+        # segmentsの最後から最初に回り込むときは、残りの部分を反転すると巡回路全体が逆向きになるので、
+        # rev_allも反転して向きを合わせる
+        i, j = self.seg[a].rank, self.seg[b].rank
+        if i > j:
+            i, j = j + 1, i - 1
+            self.rev_all = not self.rev_all
+        segments = self.segments
+        segments[i: j + 1] = segments[i: j + 1][::-1]
+        for rank in range(i, j + 1):
+            segment = segments[rank]
+            segment.rank = rank
+            segment.rev = not segment.rev
+
+        if len(segments) > self.max_segments:
+            self.rebuild(self.sequence())
+
+    def sequence(self, start_city=None):
+        """
+        Returns the cities in tour order as a list, starting from start_city if given.
+        """
+        order = []
+        for segment in self.segments:
+            order.extend(reversed(segment.cities) if segment.rev else segment.cities)
+        if self.rev_all:
+            order.reverse()
+        if start_city is not None:
+            k = order.index(start_city)
+            order = order[k:] + order[:k]
+        return order
+
+    def tour(self, start_city):
+        """
+        Returns the tour as a list that starts and ends with start_city, like the solvers use.
+        """
+        return self.sequence(start_city) + [start_city]